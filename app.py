@@ -1,4 +1,10 @@
 import os
+import subprocess
+import sys
 os.system("python manage.py makemigrations")
 os.system("python manage.py migrate")
-os.system("python manage.py runserver 5000")
\ No newline at end of file
+workers = subprocess.Popen([sys.executable, "manage.py", "run_classifier_workers"])
+try:
+    os.system("python manage.py runserver 5000")
+finally:
+    workers.terminate()
\ No newline at end of file
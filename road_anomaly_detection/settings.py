@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -155,7 +156,146 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # model temp path for prediction
 
 MODEL_MEDIA_ROOT = BASE_DIR / 'road_anomaly_detection_model/temp'
+
+# scratch space for files the pipeline has to put on disk (see
+# road_anomaly_detection_model/temp/temp.py): per-job directories under
+# MODEL_MEDIA_ROOT, or /dev/shm with SCRATCH_ON_TMPFS, at most
+# SCRATCH_QUOTA_BYTES in total; the sweeper removes leftovers older than
+# SCRATCH_MAX_AGE_SECONDS every SCRATCH_SWEEP_INTERVAL_SECONDS
+SCRATCH_ON_TMPFS = os.environ.get('SCRATCH_ON_TMPFS', '0') == '1'
+SCRATCH_QUOTA_BYTES = 2 * 1024 * 1024 * 1024
+SCRATCH_MAX_AGE_SECONDS = 3600
+SCRATCH_SWEEP_INTERVAL_SECONDS = 600
+
+# object store for uploaded media and annotated images; the tables only
+# keep keys (see road_anomaly_detection_app/storage.py). A class with the
+# same S3-style methods can replace the local directory store. With
+# BLOB_STORE_SENDFILE_HEADER (e.g. 'X-Accel-Redirect' for nginx or
+# 'X-Sendfile' for Apache) images are sent by the web server from
+# BLOB_STORE_SENDFILE_PREFIX + the object's path under BLOB_STORE_ROOT
+BLOB_STORE_BACKEND = 'road_anomaly_detection_app.storage.FileSystemBlobStore'
+BLOB_STORE_ROOT = Path(os.environ.get('BLOB_STORE_ROOT', BASE_DIR / 'blobstore'))
+BLOB_STORE_SENDFILE_HEADER = os.environ.get('BLOB_STORE_SENDFILE_HEADER') or None
+BLOB_STORE_SENDFILE_PREFIX = '/protected/blobs/'
 MODEL_ROOT = BASE_DIR / 'road_anomaly_detection_model/models'
+MODEL_WEIGHTS = MODEL_ROOT / 'best.pt'
+
+# inference backend: 'torch' (ultralytics) or 'onnx' (ONNX Runtime on CPU,
+# export with `python -m road_anomaly_detection_model.engines export`)
+MODEL_ENGINE = os.environ.get('MODEL_ENGINE', 'torch')
+MODEL_ONNX_WEIGHTS = MODEL_ROOT / 'best.onnx'
+
+# inference image size, also used for the warm-up pass
+MODEL_IMGSZ = 640
+
+# load the model and run a warm-up inference when the app starts
+# (off by default so manage.py commands and web workers stay light)
+MODEL_WARMUP_ON_START = os.environ.get('MODEL_WARMUP_ON_START', '0') == '1'
+
+# images per YOLO forward pass for batched classification
+MODEL_BATCH_SIZE = 8
+
+# minimum confidence of a reported detection
+MODEL_CONF_THRESHOLD = 0.3
+
+# micro-batching inference service shared by all classification jobs:
+# pending images are run together once INFERENCE_MAX_BATCH_SIZE are queued
+# or the first one has waited INFERENCE_MAX_WAIT_MS
+INFERENCE_MAX_BATCH_SIZE = 8
+INFERENCE_MAX_WAIT_MS = 20
+
+# process pool of model replicas (0 = infer inside this process); each
+# replica uses INFERENCE_THREADS_PER_PROCESS intra-op threads (default:
+# cores / replicas) and with INFERENCE_PIN_CPUS gets its own CPU set
+INFERENCE_PROCESSES = int(os.environ.get('INFERENCE_PROCESSES', '0'))
+INFERENCE_THREADS_PER_PROCESS = None
+INFERENCE_PIN_CPUS = os.environ.get('INFERENCE_PIN_CPUS', '0') == '1'
+
+# tiled inference for high-resolution images (opt-in): images whose longer
+# side exceeds MODEL_TILE_MIN_SIDE are cut into overlapping native-resolution
+# tiles, at most MODEL_MAX_TILES_IN_MEMORY of them sent to the model at once
+MODEL_TILED = os.environ.get('MODEL_TILED', '0') == '1'
+MODEL_TILE_SIZE = 640
+MODEL_TILE_OVERLAP = 0.2
+MODEL_TILE_MIN_SIDE = 1280
+MODEL_MAX_TILES_IN_MEMORY = 8
+
+# per-stage timing of the classification pipeline: None (off), 'log',
+# 'memory' or the dotted path of a sink class (see road_anomaly_detection_model/timing.py)
+PIPELINE_TIMING_SINK = os.environ.get('PIPELINE_TIMING_SINK') or None
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'road_anomaly_detection.timing': {'handlers': ['console'], 'level': 'INFO', 'propagate': False},
+    },
+}
+
+# content-hash cache of classification results (SQLite, LRU eviction by size)
+MODEL_CACHE_ENABLED = os.environ.get('MODEL_CACHE_ENABLED', '1') == '1'
+MODEL_CACHE_PATH = BASE_DIR / 'road_anomaly_detection_model/cache.sqlite3'
+MODEL_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# video frame selection: VIDEO_CANDIDATE_FACTOR x max_frames evenly spaced
+# candidates are read, frames whose 64-bit difference hash is within
+# VIDEO_DUPLICATE_THRESHOLD bits of an already selected one are dropped and
+# the frames that differ most from their predecessor are classified
+VIDEO_CANDIDATE_FACTOR = 3
+VIDEO_DUPLICATE_THRESHOLD = 6
+
+# pipelined video classification: a decoder thread feeds selected frames
+# through a queue of at most VIDEO_QUEUE_SIZE frames while earlier frames
+# are being classified, so decoding and inference overlap
+VIDEO_PIPELINE = os.environ.get('VIDEO_PIPELINE', '0') == '1'
+VIDEO_QUEUE_SIZE = 16
+
+# long videos are classified in segments of VIDEO_SEGMENT_SECONDS whose
+# results are checkpointed (VideoSegment), so a restarted worker resumes
+# where it stopped and several workers can share one video; a segment
+# leased by a worker that stopped responding is taken over after
+# VIDEO_SEGMENT_LEASE_SECONDS
+VIDEO_SEGMENT_SECONDS = 60
+VIDEO_SEGMENT_LEASE_SECONDS = 600
+VIDEO_SEGMENT_POLL_SECONDS = 2
+
+# durable classification jobs (ClassificationJob), run by
+# `python manage.py run_classifier_workers --concurrency N`; a job leased
+# by a worker that stopped responding is leased again after
+# CLASSIFIER_JOB_LEASE_SECONDS, failed jobs are retried after
+# CLASSIFIER_JOB_RETRY_DELAY_SECONDS up to CLASSIFIER_JOB_MAX_ATTEMPTS times
+CLASSIFIER_WORKER_CONCURRENCY = int(os.environ.get('CLASSIFIER_WORKER_CONCURRENCY', '2'))
+CLASSIFIER_WORKER_POLL_SECONDS = 1
+CLASSIFIER_JOB_LEASE_SECONDS = 300
+CLASSIFIER_JOB_MAX_ATTEMPTS = 3
+CLASSIFIER_JOB_RETRY_DELAY_SECONDS = 30
+
+# frames classified per video (per segment for long videos)
+VIDEO_MAX_FRAMES = 10
+
+# admission control: the backlog is the cost (frames to classify, one per
+# image) of queued and running jobs. Past ADMISSION_DEFER_WATERMARK new jobs
+# wait until the backlog should have drained at ADMISSION_COST_PER_SECOND;
+# past ADMISSION_REJECT_WATERMARK API clients get 429 with Retry-After
+ADMISSION_IMAGE_COST = 1
+ADMISSION_DEFER_WATERMARK = int(os.environ.get('ADMISSION_DEFER_WATERMARK', '200'))
+ADMISSION_REJECT_WATERMARK = int(os.environ.get('ADMISSION_REJECT_WATERMARK', '1000'))
+ADMISSION_COST_PER_SECOND = 5
+# decoding cost of the upload itself: one unit per this many bytes
+ADMISSION_BYTES_PER_COST = 8 * 1024 * 1024
+
+# job scheduling: shortest job first with aging. A job's deadline is its
+# enqueue time plus SCHEDULER_SECONDS_PER_COST per unit of cost, minus
+# SCHEDULER_PRIORITY_SECONDS per priority level; the earliest deadline
+# runs first, so photos overtake a long video but only for a bounded time.
+# Staff uploads and reports in SCHEDULER_PRIORITY_PINCODES get priority 1
+SCHEDULER_SECONDS_PER_COST = 2
+SCHEDULER_PRIORITY_SECONDS = 600
+SCHEDULER_STAFF_PRIORITY = 1
+SCHEDULER_PRIORITY_PINCODES = []
 
 
 
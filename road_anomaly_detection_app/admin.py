@@ -3,5 +3,32 @@ from road_anomaly_detection_app import models
 
 # Register your models here.
 admin.site.register(models.User)
-admin.site.register(models.RoadAnomalyReport)
-admin.site.register(models.MediaContent)
\ No newline at end of file
+
+
+@admin.register(models.RoadAnomalyReport)
+class RoadAnomalyReportAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'register', 'roadname', 'anomalyType', 'status', 'has_image', 'image_size', 'model_version', 'posted_at')
+    list_filter = ('status', 'filetype', 'has_image', 'model_version')
+    search_fields = ('register', 'roadname', 'areaname')
+    date_hierarchy = 'posted_at'
+    # Counting every row twice per page adds up on a large table
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        # The annotated image is never shown here
+        return super().get_queryset(request).defer('anomalyImage')
+
+
+@admin.register(models.MediaContent)
+class MediaContentAdmin(admin.ModelAdmin):
+    list_display = ('file_id', 'content_type', 'size', 'ref_count', 'blob_key')
+    list_filter = ('content_type',)
+    search_fields = ('file_id',)
+    show_full_result_count = False
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).defer('binary_data')
+
+
+admin.site.register(models.VideoSegment)
+admin.site.register(models.ClassificationJob)
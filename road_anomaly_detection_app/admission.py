@@ -0,0 +1,141 @@
+"""
+Admission control for new classification work.
+
+The cost of a job is the number of frames the model will classify: one
+per image, `VIDEO_MAX_FRAMES` per video segment, plus one unit per
+ADMISSION_BYTES_PER_COST bytes of upload to decode. The backlog is the cost
+of the queued and running jobs. Once it passes ADMISSION_DEFER_WATERMARK
+new reports are still stored but their job is deferred until the
+backlog should have drained. Past ADMISSION_REJECT_WATERMARK API clients
+get 429 with a Retry-After instead.
+"""
+import math
+from collections import namedtuple
+
+import cv2
+from django.conf import settings
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import Coalesce, Length
+from django.utils import timezone
+
+from road_anomaly_detection_app.models import ClassificationJob, FileTypeChoise, JobStatusChoise, MediaContent
+from road_anomaly_detection_model.video import open_video_bytes, plan_segments
+
+
+RUN = 'run'
+DEFER = 'defer'
+REJECT = 'reject'
+
+Decision = namedtuple('Decision', ['action', 'cost', 'retry_after'])
+
+VIDEO_EXTENSIONS = ('mp4', 'avi', 'mov')
+
+
+def video_cost(cap):
+    """Frames classified for an opened video."""
+    segments = plan_segments(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), cap.get(cv2.CAP_PROP_FPS), settings.VIDEO_SEGMENT_SECONDS)
+    return len(segments) * settings.VIDEO_MAX_FRAMES
+
+
+def estimate_cost(uploaded_files):
+    """
+    Estimated cost of classifying `uploaded_files` (Django UploadedFiles).
+    Videos are measured from their header; the files are rewound after.
+    """
+    cost = 0
+    for uploaded_file in uploaded_files:
+        cost += (uploaded_file.size or 0) / settings.ADMISSION_BYTES_PER_COST
+        if uploaded_file.name.split('.')[-1].lower() not in VIDEO_EXTENSIONS:
+            cost += settings.ADMISSION_IMAGE_COST
+            continue
+
+        try:
+            if hasattr(uploaded_file, 'temporary_file_path'):
+                cap = cv2.VideoCapture(uploaded_file.temporary_file_path())
+                try:
+                    cost += video_cost(cap)
+                finally:
+                    cap.release()
+            else:
+                with open_video_bytes(uploaded_file.read()) as cap:
+                    cost += video_cost(cap)
+        except ValueError:
+            # Unreadable video: it fails fast in the worker
+            cost += settings.VIDEO_MAX_FRAMES
+        finally:
+            uploaded_file.seek(0)
+    return cost
+
+
+def estimate_report_cost(report):
+    """
+    Estimated cost of a stored report, from the type and size of its files
+    (the video length is not known without decoding, one segment is assumed).
+    """
+    sizes = dict(
+        MediaContent.objects
+        .filter(file_id__in=[f['file_id'] for f in report.files])
+        .annotate(bytes=Coalesce('size', Length('binary_data')))
+        .values_list('file_id', 'bytes')
+    )
+
+    cost = 0
+    for f in report.files:
+        cost += (sizes.get(f['file_id']) or 0) / settings.ADMISSION_BYTES_PER_COST
+        cost += settings.VIDEO_MAX_FRAMES if f['file_type'] == FileTypeChoise.VIDEO else settings.ADMISSION_IMAGE_COST
+    return max(cost, settings.ADMISSION_IMAGE_COST)
+
+
+def queue_depth():
+    """
+    Jobs and their cost by state. `deferred` jobs are queued but not due yet.
+    """
+    now = timezone.now()
+    queued = Q(status=JobStatusChoise.QUEUED)
+    running = Q(status=JobStatusChoise.RUNNING)
+    deferred = queued & Q(run_after__gt=now)
+
+    depth = ClassificationJob.objects.filter(queued | running).aggregate(
+        queued=Count('pk', filter=queued),
+        running=Count('pk', filter=running),
+        deferred=Count('pk', filter=deferred),
+        queued_cost=Sum('cost', filter=queued, default=0.0),
+        running_cost=Sum('cost', filter=running, default=0.0),
+    )
+    depth['backlog_cost'] = depth['queued_cost'] + depth['running_cost']
+    depth['retry_after'] = retry_after(depth['backlog_cost'])
+    return depth
+
+
+def retry_after(backlog_cost):
+    """Seconds until a backlog of `backlog_cost` should have drained."""
+    return max(1, math.ceil(backlog_cost / settings.ADMISSION_COST_PER_SECOND))
+
+
+def admit(cost, can_reject = False):
+    """
+    Decide what to do with new work of `cost`.
+
+    Args:
+        cost: Estimated cost, see `estimate_cost`
+        can_reject: Whether the client understands 429 (API clients)
+
+    Returns:
+        Decision(action, cost, retry_after): RUN now, DEFER the job by
+        `retry_after` seconds, or REJECT the upload
+    """
+    backlog = queue_depth()['backlog_cost'] + cost
+
+    if backlog <= settings.ADMISSION_DEFER_WATERMARK:
+        return Decision(RUN, cost, 0)
+    if can_reject and backlog > settings.ADMISSION_REJECT_WATERMARK:
+        return Decision(REJECT, cost, retry_after(backlog))
+    return Decision(DEFER, cost, retry_after(backlog))
+
+
+def wants_json(request):
+    """API clients (fetch/XHR or JSON Accept) rather than a browser form post."""
+    return (
+        request.headers.get('X-Requested-With') == 'XMLHttpRequest'
+        or 'application/json' in request.headers.get('Accept', '')
+    )
@@ -1,6 +1,16 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class RoadAnomalyDetectionAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'road_anomaly_detection_app'
+
+    def ready(self):
+        if settings.MODEL_WARMUP_ON_START:
+            from threading import Thread
+            from road_anomaly_detection_model.model import warmup
+
+            # Warm up in the background so startup is not blocked on torch
+            thread = Thread(target=warmup, daemon=True)
+            thread.start()
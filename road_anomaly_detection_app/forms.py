@@ -418,19 +418,13 @@ class RoadAnomalyReportForm():
                     else:
                         ValidationError("Unknown File Type.")
                     # Add more mappings as needed
-                    file_id = f"{uuid.uuid4()} - {self.cleaned_data['register_ID']}"
-                    # Create MediaContent instance
-                    media_content = MediaContent(
-                        file_id = file_id,
-                        binary_data = uploaded_file.read(),
-                        content_type = file_type
-                    )
-                    media_content.save()
+                    # Stored under its content hash; identical uploads share one blob
+                    file_id = MediaContent.objects.store(uploaded_file.read(), file_type)
 
                     # Append to files JSON: {'file_type': str, 'file_id': str(media_content.id)}
                     media_files.append({
                         'file_type': file_type,
-                        'file_id': str(media_content.file_id)
+                        'file_id': file_id
                     })
 
                 # Update the report's files field
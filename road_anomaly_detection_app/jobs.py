@@ -0,0 +1,256 @@
+"""
+Database-backed queue of classification jobs.
+
+Uploads enqueue a ClassificationJob; `manage.py run_classifier_workers`
+leases and runs them outside the web process. Jobs live in the database,
+so they survive restarts and need no broker. Leasing uses
+SELECT ... FOR UPDATE SKIP LOCKED where the database supports it
+(PostgreSQL, MySQL 8) and a conditional UPDATE elsewhere (SQLite).
+Jobs run in `deadline` order: shortest job first with aging and priority.
+"""
+import logging
+import os
+import socket
+import threading
+import traceback
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from road_anomaly_detection_app.admission import estimate_report_cost
+from road_anomaly_detection_app.models import ClassificationJob, JobStatusChoise, RoadAnomalyReport, StatusTypeChoise
+from road_anomaly_detection_app.tasks import classify_next_segment, classify_report
+
+
+logger = logging.getLogger(__name__)
+
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def deadline(enqueued_at, cost, priority = 0):
+    """
+    Scheduling key of a job: cheap jobs get an earlier deadline than
+    expensive ones enqueued at the same time (shortest job first), while a
+    job that has waited longer than the cost difference wins regardless
+    (aging), so large videos are delayed but never starved.
+    """
+    return enqueued_at + timedelta(
+        seconds=cost * settings.SCHEDULER_SECONDS_PER_COST - priority * settings.SCHEDULER_PRIORITY_SECONDS
+    )
+
+
+def priority_for(report, user = None):
+    """Scheduling priority of a report: staff uploads and priority areas first."""
+    priority = 0
+    if user is not None and getattr(user, 'is_staff', False):
+        priority += settings.SCHEDULER_STAFF_PRIORITY
+    if report.pincode is not None and report.pincode in settings.SCHEDULER_PRIORITY_PINCODES:
+        priority += 1
+    return priority
+
+
+def enqueue(report, cost = None, delay = 0, priority = None):
+    """
+    Queue the classification of `report`, unless it is already queued or running.
+
+    Args:
+        report: RoadAnomalyReport to classify
+        cost: Estimated cost (see admission.estimate_cost), estimated from
+              the stored files by default
+        delay: Seconds before workers may lease the job
+        priority: Scheduling priority, see `priority_for` (the default)
+
+    Returns:
+        The ClassificationJob
+    """
+    active = report.jobs.filter(status__in=[JobStatusChoise.QUEUED, JobStatusChoise.RUNNING]).first()
+    if active is not None:
+        return active
+
+    if cost is None:
+        cost = estimate_report_cost(report)
+    if priority is None:
+        priority = priority_for(report)
+
+    now = timezone.now()
+    run_after = now + timedelta(seconds=delay)
+    return ClassificationJob.objects.create(
+        report=report,
+        cost=cost,
+        priority=priority,
+        run_after=run_after,
+        deadline=deadline(run_after, cost, priority),
+        max_attempts=settings.CLASSIFIER_JOB_MAX_ATTEMPTS,
+    )
+
+
+def _ready(now):
+    return (
+        Q(status=JobStatusChoise.QUEUED, run_after__lte=now)
+        | Q(status=JobStatusChoise.RUNNING, lease_expires_at__lt=now, attempts__lt=F('max_attempts'))
+    )
+
+
+def _fail_abandoned(now):
+    """
+    Give up on jobs whose lease expired on their last attempt. `fail` never
+    runs for them when the worker was killed (e.g. OOM, or a video that
+    crashes FFmpeg), and leasing them again would crash-loop the workers.
+    """
+    abandoned = ClassificationJob.objects.filter(
+        status=JobStatusChoise.RUNNING, lease_expires_at__lt=now, attempts__gte=F('max_attempts'),
+    )
+    jobs = list(abandoned.values_list('pk', 'report_id'))
+    if not jobs:
+        return
+
+    abandoned.filter(pk__in=[pk for pk, _ in jobs]).update(
+        status=JobStatusChoise.FAILED, lease_expires_at=None,
+        last_error="Worker stopped responding on the last attempt", updated_at=now,
+    )
+    RoadAnomalyReport.objects.filter(pk__in=[report_id for _, report_id in jobs]).update(status=StatusTypeChoise.ERROR)
+    logger.warning("Gave up on abandoned classification jobs %s", [pk for pk, _ in jobs])
+
+
+def lease(worker):
+    """
+    Lease the runnable job with the earliest deadline for `worker`: queued
+    and due, or running with an expired lease and attempts left. Counts as
+    an attempt.
+
+    Returns:
+        The leased ClassificationJob or None
+    """
+    now = timezone.now()
+    _fail_abandoned(now)
+    lease_expires_at = now + timedelta(seconds=settings.CLASSIFIER_JOB_LEASE_SECONDS)
+    runnable = ClassificationJob.objects.filter(_ready(now)).order_by('deadline', 'pk')
+
+    if connection.features.has_select_for_update_skip_locked:
+        with transaction.atomic():
+            job = runnable.select_for_update(skip_locked=True).first()
+            if job is None:
+                return None
+            job.status = JobStatusChoise.RUNNING
+            job.locked_by = worker
+            job.lease_expires_at = lease_expires_at
+            job.attempts += 1
+            job.save(update_fields=['status', 'locked_by', 'lease_expires_at', 'attempts', 'updated_at'])
+            return job
+
+    # No row locks: the conditional update succeeds for one worker only
+    for pk in runnable.values_list('pk', flat=True)[:10]:
+        claimed = ClassificationJob.objects.filter(_ready(now), pk=pk).update(
+            status=JobStatusChoise.RUNNING,
+            locked_by=worker,
+            lease_expires_at=lease_expires_at,
+            attempts=F('attempts') + 1,
+            updated_at=now,
+        )
+        if claimed:
+            return ClassificationJob.objects.get(pk=pk)
+    return None
+
+
+def extend_lease(job):
+    """Push back the lease of a job this worker still holds."""
+    return ClassificationJob.objects.filter(pk=job.pk, locked_by=job.locked_by, status=JobStatusChoise.RUNNING).update(
+        lease_expires_at=timezone.now() + timedelta(seconds=settings.CLASSIFIER_JOB_LEASE_SECONDS),
+    )
+
+
+def complete(job):
+    ClassificationJob.objects.filter(pk=job.pk, locked_by=job.locked_by).update(
+        status=JobStatusChoise.DONE, lease_expires_at=None, last_error=None, updated_at=timezone.now(),
+    )
+
+
+def fail(job, error):
+    """
+    Record a failed attempt: retry later, or give up and mark the report
+    as errored once `max_attempts` is reached.
+    """
+    now = timezone.now()
+    jobs = ClassificationJob.objects.filter(pk=job.pk, locked_by=job.locked_by)
+
+    if job.attempts < job.max_attempts:
+        jobs.update(
+            status=JobStatusChoise.QUEUED,
+            run_after=now + timedelta(seconds=settings.CLASSIFIER_JOB_RETRY_DELAY_SECONDS * job.attempts),
+            lease_expires_at=None, last_error=error, updated_at=now,
+        )
+        return
+
+    jobs.update(status=JobStatusChoise.FAILED, lease_expires_at=None, last_error=error, updated_at=now)
+    RoadAnomalyReport.objects.filter(pk=job.report_id).update(status=StatusTypeChoise.ERROR)
+
+
+def run(job):
+    """
+    Run a leased job, extending its lease while the classification runs.
+    """
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(settings.CLASSIFIER_JOB_LEASE_SECONDS / 3):
+            extend_lease(job)
+        close_old_connections()
+
+    thread = threading.Thread(target=heartbeat, name=f'job-{job.pk}-heartbeat', daemon=True)
+    thread.start()
+    try:
+        report = RoadAnomalyReport.objects.defer('anomalyImage').filter(pk=job.report_id).first()
+        if report is not None:
+            classify_report(report)
+    except Exception:
+        logger.exception("Classification job %s failed (attempt %s of %s)", job.pk, job.attempts, job.max_attempts)
+        fail(job, traceback.format_exc())
+    else:
+        complete(job)
+    finally:
+        stop.set()
+        thread.join()
+
+
+def help_with_video(worker):
+    """
+    Classify a segment of a long video another worker is running, when
+    there is one. Returns whether there was.
+    """
+    try:
+        return classify_next_segment(worker)
+    except Exception:
+        # The segment is marked failed; the report's own worker retries it
+        logger.exception("Video segment failed")
+        return True
+
+
+def work(stop, poll_interval = None, worker = None, once = False):
+    """
+    Lease and run jobs until `stop` is set, waiting `poll_interval` seconds
+    when the queue is empty (or returning, with `once`). Without a job to
+    run, workers help with the segments of long videos being classified.
+    """
+    if poll_interval is None:
+        poll_interval = settings.CLASSIFIER_WORKER_POLL_SECONDS
+    worker = worker or worker_name()
+
+    try:
+        while not stop.is_set():
+            close_old_connections()
+            job = lease(worker)
+            if job is not None:
+                run(job)
+            elif help_with_video(worker):
+                continue
+            elif once:
+                return
+            else:
+                stop.wait(poll_interval)
+    finally:
+        connection.close()
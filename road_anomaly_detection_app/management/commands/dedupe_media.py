@@ -0,0 +1,98 @@
+import hashlib
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from road_anomaly_detection_app.models import MediaContent, RoadAnomalyReport
+
+
+class Command(BaseCommand):
+    help = (
+        "Move media stored before content addressing to their SHA-256 keys: "
+        "identical blobs are merged into one row and reports are pointed at it."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500, help="Reports updated per query")
+
+    def handle(self, *args, **options):
+        hashed = self.hash_legacy_rows()
+        self.stdout.write(f"Hashed {hashed} media rows")
+
+        # Metadata only from here on; one transaction, so reports never
+        # point at a key that does not exist yet
+        with transaction.atomic():
+            rewritten = self.rewrite_reports(options['chunk_size'])
+            promoted, merged = self.merge_legacy_rows()
+            MediaContent.objects.recount_references()
+            collected = MediaContent.objects.collect_garbage()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Rewrote {rewritten} reports, kept {promoted} blobs, removed {merged} duplicates "
+            f"and {collected} unreferenced blobs"
+        ))
+
+    def hash_legacy_rows(self):
+        """
+        Record the SHA-256 of every row that has none yet, one blob in
+        memory at a time. Resumable: hashed rows are skipped.
+        """
+        count = 0
+        rows = MediaContent.objects.filter(sha256__isnull=True).only('file_id', 'binary_data').iterator(chunk_size=1)
+        for media in rows:
+            digest = hashlib.sha256(bytes(media.binary_data or b'')).hexdigest()
+            MediaContent.objects.filter(file_id=media.file_id).update(sha256=digest)
+            count += 1
+        return count
+
+    def rewrite_reports(self, chunk_size):
+        legacy = MediaContent.objects.exclude(file_id=F('sha256')).filter(sha256__isnull=False)
+        rewritten = 0
+
+        reports = RoadAnomalyReport.objects.only('pk', 'files').order_by('pk').iterator(chunk_size=chunk_size)
+        chunk = []
+        for report in reports:
+            chunk.append(report)
+            if len(chunk) == chunk_size:
+                rewritten += self.rewrite_chunk(chunk, legacy)
+                chunk = []
+        if chunk:
+            rewritten += self.rewrite_chunk(chunk, legacy)
+        return rewritten
+
+    def rewrite_chunk(self, reports, legacy):
+        ids = {f['file_id'] for report in reports for f in report.files or []}
+        keys = dict(legacy.filter(file_id__in=ids).values_list('file_id', 'sha256'))
+        if not keys:
+            return 0
+
+        changed = []
+        for report in reports:
+            files = [{**f, 'file_id': keys.get(f['file_id'], f['file_id'])} for f in report.files or []]
+            if files != report.files:
+                report.files = files
+                changed.append(report)
+
+        RoadAnomalyReport.objects.bulk_update(changed, ['files'])
+        return len(changed)
+
+    def merge_legacy_rows(self):
+        """
+        Rename the first legacy row of each hash to the hash (no blob copy)
+        unless that key exists already, and delete the other copies.
+        """
+        legacy = MediaContent.objects.exclude(file_id=F('sha256')).filter(sha256__isnull=False)
+        digests = set(legacy.values_list('sha256', flat=True))
+        existing = set(MediaContent.objects.filter(file_id__in=digests).values_list('file_id', flat=True))
+
+        promoted = merged = 0
+        for file_id, digest in legacy.order_by('file_id').values_list('file_id', 'sha256'):
+            if digest in existing:
+                MediaContent.objects.filter(file_id=file_id).delete()
+                merged += 1
+            else:
+                MediaContent.objects.filter(file_id=file_id).update(file_id=digest)
+                existing.add(digest)
+                promoted += 1
+        return promoted, merged
@@ -0,0 +1,46 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from road_anomaly_detection_app import storage
+from road_anomaly_detection_app.models import MediaContent, RoadAnomalyReport
+
+
+class Command(BaseCommand):
+    help = "Delete stored media and annotated images that no report refers to."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--recount', action='store_true',
+            help="Recompute reference counts from the reports first (repairs counts left by failed uploads)",
+        )
+        parser.add_argument(
+            '--images', action='store_true',
+            help="Also delete annotated images left behind by reclassified reports",
+        )
+        parser.add_argument(
+            '--min-age', type=int, default=3600,
+            help="Keep images written in the last this many seconds (their report may not be saved yet)",
+        )
+
+    def handle(self, *args, **options):
+        if options['recount']:
+            MediaContent.objects.recount_references()
+
+        collected = MediaContent.objects.collect_garbage()
+        self.stdout.write(self.style.SUCCESS(f"Deleted {collected} unreferenced blobs"))
+
+        if options['images']:
+            store = storage.get_store()
+            cutoff = time.time() - options['min_age']
+            referenced = set(
+                RoadAnomalyReport.objects.exclude(anomaly_image_key=None)
+                .values_list('anomaly_image_key', flat=True).iterator(chunk_size=2000)
+            )
+            deleted = 0
+            for key in list(store.list_objects('images')):
+                if key in referenced or (store.modified_at(key) or 0) > cutoff:
+                    continue
+                # Checked again once out of sight, for reports saved since
+                deleted += storage.delete_unreferenced(key, RoadAnomalyReport.objects.filter(anomaly_image_key=key).exists)
+            self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} unreferenced images"))
@@ -0,0 +1,72 @@
+import hashlib
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from road_anomaly_detection_app import storage
+from road_anomaly_detection_app.models import MediaContent, RoadAnomalyReport
+
+
+class Command(BaseCommand):
+    help = (
+        "Move media and annotated image blobs from the database into the blob "
+        "store, leaving only their keys. Resumable: moved rows are skipped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--vacuum', action='store_true', help="VACUUM the SQLite database afterwards to give the space back")
+
+    def handle(self, *args, **options):
+        moved = freed = 0
+        # One blob in memory at a time
+        rows = (
+            MediaContent.objects.filter(blob_key__isnull=True, binary_data__isnull=False)
+            .only('file_id', 'sha256', 'binary_data')
+            .iterator(chunk_size=1)
+        )
+        for media in rows:
+            data = bytes(media.binary_data)
+            digest = media.sha256 or hashlib.sha256(data).hexdigest()
+            key = storage.put_content('media', data, digest)
+            MediaContent.objects.filter(file_id=media.file_id).update(
+                blob_key=key, sha256=digest, size=len(data), binary_data=None,
+            )
+            moved, freed = moved + 1, freed + len(data)
+        self.stdout.write(f"Moved {moved} media blobs ({freed} bytes)")
+
+        moved = freed = 0
+        reports = (
+            RoadAnomalyReport.objects.filter(anomaly_image_key__isnull=True, anomalyImage__isnull=False)
+            .only('pk', 'anomalyImage')
+            .iterator(chunk_size=1)
+        )
+        for report in reports:
+            data = bytes(report.anomalyImage)
+            key = storage.put_content('images', data)
+            RoadAnomalyReport.objects.filter(pk=report.pk).update(
+                anomaly_image_key=key, anomalyImage=None, has_image=True, image_size=len(data),
+            )
+            moved, freed = moved + 1, freed + len(data)
+        self.stdout.write(f"Moved {moved} anomaly images ({freed} bytes)")
+
+        # Images stored before reports recorded has_image/image_size
+        store = storage.get_store()
+        filled = 0
+        reports = (
+            RoadAnomalyReport.objects.filter(has_image=False, anomaly_image_key__isnull=False)
+            .values_list('pk', 'anomaly_image_key')
+            .iterator(chunk_size=2000)
+        )
+        for pk, key in reports:
+            size = store.head_object(key)
+            if size is not None:
+                RoadAnomalyReport.objects.filter(pk=pk).update(has_image=True, image_size=size)
+                filled += 1
+        self.stdout.write(f"Recorded the size of {filled} stored images")
+
+        if options['vacuum'] and connection.vendor == 'sqlite':
+            self.stdout.write("Vacuuming the database")
+            with connection.cursor() as cursor:
+                cursor.execute('VACUUM')
+
+        self.stdout.write(self.style.SUCCESS("Done"))
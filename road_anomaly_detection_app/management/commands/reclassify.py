@@ -0,0 +1,171 @@
+import json
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Q
+from django.utils.dateparse import parse_date
+
+from road_anomaly_detection_app import reclassify
+from road_anomaly_detection_app.models import RoadAnomalyReport, StatusTypeChoise, VideoSegment
+from road_anomaly_detection_model.model import model_version
+from road_anomaly_detection_model.pool import plan_replicas
+
+
+FIELDS = ['anomalyType', 'anomaly_image_key', 'anomalyImage', 'has_image', 'image_size', 'model_version', 'status']
+
+
+class Command(BaseCommand):
+    help = (
+        "Reclassify stored reports with the current model. Progress is "
+        "checkpointed, so an interrupted run resumes where it stopped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--status', nargs='+', choices=StatusTypeChoise.values, help="Only reports with these statuses")
+        parser.add_argument('--since', help="Only reports posted on or after this date (YYYY-MM-DD)")
+        parser.add_argument('--until', help="Only reports posted on or before this date (YYYY-MM-DD)")
+        parser.add_argument('--model-version', nargs='+', help="Only reports classified by these versions ('none' for never)")
+        parser.add_argument('--outdated', action='store_true', help="Skip reports already classified by the current model")
+        parser.add_argument('--processes', type=int, default=2, help="Worker processes, each with its own model (0: this process)")
+        parser.add_argument('--threads', type=int, default=None, help="Inference threads per worker (default: cores / processes)")
+        parser.add_argument('--chunk-size', type=int, default=16, help="Reports per worker task, classified as one batch")
+        parser.add_argument('--query-chunk-size', type=int, default=2000, help="Report ids fetched from the database at a time")
+        parser.add_argument('--checkpoint', default=str(settings.BASE_DIR / 'reclassify.checkpoint.json'))
+        parser.add_argument('--restart', action='store_true', help="Ignore an existing checkpoint")
+
+    def handle(self, *args, **options):
+        reports = self.select(options)
+        checkpoint_path = Path(options['checkpoint'])
+        checkpoint = self.load_checkpoint(checkpoint_path, options)
+        if checkpoint['last_pk'] is not None:
+            self.stdout.write(f"Resuming after report {checkpoint['last_pk']} ({checkpoint['done']} done)")
+            reports = reports.filter(pk__gt=checkpoint['last_pk'])
+
+        total = reports.count()
+        self.stdout.write(f"Reclassifying {total} reports with {model_version()}")
+
+        ids = reports.values_list('pk', flat=True).iterator(chunk_size=options['query_chunk_size'])
+        chunks = iter(lambda: list(islice(ids, options['chunk_size'])), [])
+
+        executor = None
+        if options['processes'] > 0:
+            threads, cpu_sets = plan_replicas(options['processes'], options['threads'], settings.INFERENCE_PIN_CPUS)
+            context = multiprocessing.get_context('spawn')
+            executor = ProcessPoolExecutor(
+                max_workers=options['processes'],
+                mp_context=context,
+                initializer=reclassify.init_worker,
+                initargs=(context.Value('i', 0), threads, cpu_sets),
+            )
+
+        started = time.monotonic()
+        done = failed = 0
+        # Chunks are finished in submission order, so the checkpoint only
+        # moves past reports that are all written; at most this many are in flight
+        in_flight = deque()
+        limit = max(1, options['processes']) * 2
+
+        if executor is None:
+            limit = 1
+
+        try:
+            for chunk in chunks:
+                if executor is None:
+                    future = Future()
+                    future.set_result(reclassify.classify_chunk(chunk))
+                else:
+                    future = executor.submit(reclassify.classify_chunk, chunk)
+                in_flight.append((chunk[-1], future))
+
+                while len(in_flight) >= limit:
+                    chunk_done, chunk_failed = self.finish(in_flight.popleft(), checkpoint, checkpoint_path)
+                    done, failed = done + chunk_done, failed + chunk_failed
+                    self.progress(done, failed, total, started)
+
+            while in_flight:
+                chunk_done, chunk_failed = self.finish(in_flight.popleft(), checkpoint, checkpoint_path)
+                done, failed = done + chunk_done, failed + chunk_failed
+                self.progress(done, failed, total, started)
+        except KeyboardInterrupt:
+            raise CommandError(f"Interrupted; run again to resume after report {checkpoint['last_pk']}")
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+
+        checkpoint_path.unlink(missing_ok=True)
+        self.stdout.write(self.style.SUCCESS(f"Reclassified {done} reports, {failed} failed"))
+        if checkpoint['failed']:
+            self.stdout.write(f"Failed reports: {' '.join(map(str, checkpoint['failed']))}")
+
+    def select(self, options):
+        reports = RoadAnomalyReport.objects.order_by('pk')
+        if options['status']:
+            reports = reports.filter(status__in=options['status'])
+        if options['since']:
+            reports = reports.filter(posted_at__date__gte=self.date(options['since']))
+        if options['until']:
+            reports = reports.filter(posted_at__date__lte=self.date(options['until']))
+        if options['model_version']:
+            versions = [version for version in options['model_version'] if version != 'none']
+            query = Q(model_version__in=versions)
+            if 'none' in options['model_version']:
+                query |= Q(model_version__isnull=True)
+            reports = reports.filter(query)
+        if options['outdated']:
+            reports = reports.exclude(model_version=model_version())
+        return reports
+
+    def date(self, value):
+        date = parse_date(value)
+        if date is None:
+            raise CommandError(f"Invalid date: {value}")
+        return date
+
+    def load_checkpoint(self, path, options):
+        # A checkpoint only applies to a run with the same selection
+        selection = {key: options[key] for key in ('status', 'since', 'until', 'model_version', 'outdated')}
+        if path.exists() and not options['restart']:
+            checkpoint = json.loads(path.read_text())
+            if checkpoint.get('selection') == selection:
+                return checkpoint
+            self.stdout.write("Checkpoint is for a different selection, starting over")
+        return {'selection': selection, 'last_pk': None, 'done': 0, 'failed': []}
+
+    def finish(self, item, checkpoint, path):
+        """Write the results of one chunk and move the checkpoint past it."""
+        last_pk, future = item
+        results = future.result()
+
+        updated = []
+        failed = []
+        for pk, fields, error in results:
+            if error is not None:
+                self.stderr.write(f"Report {pk}: {error}")
+                failed.append(pk)
+                continue
+            updated.append(RoadAnomalyReport(pk=pk, **fields))
+
+        RoadAnomalyReport.objects.bulk_update(updated, FIELDS)
+        VideoSegment.objects.filter(report__in=[report.pk for report in updated]).delete()
+
+        checkpoint['last_pk'] = last_pk
+        checkpoint['done'] += len(updated)
+        checkpoint['failed'] += failed
+        path.write_text(json.dumps(checkpoint))
+        return len(updated), len(failed)
+
+    def progress(self, done, failed, total, started):
+        elapsed = time.monotonic() - started
+        rate = (done + failed) / elapsed if elapsed > 0 else 0.0
+        if rate > 0:
+            eta = int((total - done - failed) / rate)
+            eta = f"{eta // 3600}:{eta % 3600 // 60:02d}:{eta % 60:02d}"
+        else:
+            eta = '?'
+        self.stdout.write(f"{done + failed}/{total} reports ({failed} failed), {rate:.1f} reports/s, ETA {eta}")
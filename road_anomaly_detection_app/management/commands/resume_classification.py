@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from road_anomaly_detection_app import jobs
+from road_anomaly_detection_app.models import RoadAnomalyReport, StatusTypeChoise
+from road_anomaly_detection_app.tasks import data_classifier
+
+
+class Command(BaseCommand):
+    help = (
+        "Queue reports left in the Processing state, e.g. after a restart. "
+        "Long videos resume from their last finished segment."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('reports', nargs='*', type=int, help="Report ids (default: every report still processing)")
+        parser.add_argument('--inline', action='store_true', help="Classify here instead of queueing for the workers")
+
+    def handle(self, *args, **options):
+        reports = RoadAnomalyReport.objects.defer('anomalyImage').filter(status=StatusTypeChoise.PROCESS)
+        if options['reports']:
+            reports = reports.filter(pk__in=options['reports'])
+
+        for report in reports.iterator():
+            self.stdout.write(f"Resuming report {report.pk}")
+            if options['inline']:
+                data_classifier(report)
+            else:
+                jobs.enqueue(report)
+
+        self.stdout.write(self.style.SUCCESS("Done"))
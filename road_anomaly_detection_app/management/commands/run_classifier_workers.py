@@ -0,0 +1,52 @@
+import signal
+import threading
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from road_anomaly_detection_app import jobs
+from road_anomaly_detection_model.temp import temp
+
+
+class Command(BaseCommand):
+    help = "Lease and run queued classification jobs until interrupted."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency', type=int, default=settings.CLASSIFIER_WORKER_CONCURRENCY,
+            help="Jobs run at the same time (their images share the inference service)",
+        )
+        parser.add_argument('--poll-interval', type=float, default=settings.CLASSIFIER_WORKER_POLL_SECONDS)
+        parser.add_argument('--once', action='store_true', help="Exit when the queue is empty")
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+
+        def shutdown(signum, frame):
+            # Running jobs finish; their reports would otherwise wait for the lease to expire
+            self.stdout.write("Stopping after the running jobs")
+            stop.set()
+
+        signal.signal(signal.SIGINT, shutdown)
+        signal.signal(signal.SIGTERM, shutdown)
+
+        # Reclaim scratch files of jobs that crashed, here or in an earlier run
+        temp.start_sweeper()
+
+        workers = [
+            threading.Thread(
+                target=jobs.work,
+                kwargs={'stop': stop, 'poll_interval': options['poll_interval'], 'once': options['once']},
+                name=f'classifier-worker-{i}',
+            )
+            for i in range(max(1, options['concurrency']))
+        ]
+        for worker in workers:
+            worker.start()
+
+        self.stdout.write(self.style.SUCCESS(f"Started {len(workers)} classifier workers"))
+
+        # Join with a timeout so the main thread keeps handling signals
+        for worker in workers:
+            while worker.is_alive():
+                worker.join(timeout=1)
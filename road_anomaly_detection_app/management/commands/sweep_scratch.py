@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from road_anomaly_detection_model.temp import temp
+
+
+class Command(BaseCommand):
+    help = "Remove scratch files left behind by crashed classification jobs."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--max-age', type=float, default=settings.SCRATCH_MAX_AGE_SECONDS,
+            help="Only remove entries older than this many seconds",
+        )
+        parser.add_argument('--all', action='store_true', help="Remove every scratch entry, regardless of age")
+
+    def handle(self, *args, **options):
+        if options['all']:
+            removed, freed = temp.clear_temp_directory()
+        else:
+            removed, freed = temp.sweep(options['max_age'])
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Removed {removed} entries ({freed} bytes) from {temp.scratch_root()}, "
+            f"{temp.usage()} bytes in use"
+        ))
@@ -1,5 +1,14 @@
+import functools
+import hashlib
 import uuid
-from django.db import models
+from collections import Counter
+from django.db import IntegrityError, models, transaction
+from django.db.models import ExpressionWrapper, F, Q
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from road_anomaly_detection_app import storage
 from django.contrib.auth.hashers import make_password, check_password
 from django.contrib.auth.models import BaseUserManager
 
@@ -106,6 +115,17 @@ class StatusTypeChoise(models.TextChoices):
     RESOLVE = 'Resolved'
     ERROR = 'Error'
 
+class RoadAnomalyReportQuerySet(models.QuerySet):
+    def without_images(self):
+        """
+        Reports without their legacy `anomalyImage` column; whether one is
+        set is still known through `has_anomaly_image`.
+        """
+        return self.defer('anomalyImage').annotate(
+            has_legacy_image=ExpressionWrapper(Q(anomalyImage__isnull=False), output_field=models.BooleanField()),
+        )
+
+
 class RoadAnomalyReport(models.Model):
     register = models.CharField(max_length=255)
     areaname = models.TextField(null=True, blank=True)
@@ -120,20 +140,58 @@ class RoadAnomalyReport(models.Model):
 
     status = models.TextField(max_length=12, choices=StatusTypeChoise.choices, default=StatusTypeChoise.PROCESS)
     anomalyType = models.TextField(null=True, blank=True)
+    # legacy: annotated images are in the blob store under anomaly_image_key
     anomalyImage = models.BinaryField(blank=True, null=True)
+    anomaly_image_key = models.CharField(max_length=100, null=True, blank=True)
+    # kept next to the key so pages never have to touch the image itself
+    has_image = models.BooleanField(default=False)
+    image_size = models.PositiveIntegerField(null=True, blank=True)
+    # engine and weights hash of the model that produced anomalyType
+    model_version = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+
+    objects = RoadAnomalyReportQuerySet.as_manager()
+
+    # What the report list and its map show
+    LIST_FIELDS = ('pk', 'anomalyType', 'roadname', 'posted_at', 'status', 'geolocation')
 
     def __str__(self):
         return str(self.register)
+
+    @property
+    def has_anomaly_image(self):
+        """
+        Whether the report has an annotated image, without loading it.
+        `has_image` is only set for images stored since it was added; older
+        ones have just the key, or the legacy column until
+        `manage.py move_blobs_to_store`.
+        """
+        if self.has_image or self.anomaly_image_key:
+            return True
+        if hasattr(self, 'has_legacy_image'):
+            return self.has_legacy_image
+        return bool(self.anomalyImage)
+
+    def get_image_bytes(self):
+        """Annotated image bytes, from the blob store or a legacy row."""
+        if self.anomaly_image_key:
+            return storage.get_store().get_object(self.anomaly_image_key)
+        if self.anomalyImage:
+            return bytes(self.anomalyImage)
+        return None
     
     def get_image_data(self):
         """Return base64-encoded image for HTML <img> tag."""
-        if self.anomalyImage:
+        image = self.get_image_bytes()
+        if image:
             import base64
-            return base64.b64encode(self.anomalyImage).decode('utf-8')
+            return base64.b64encode(image).decode('utf-8')
         return None
 
     def get_image_mime(self):
         """Guess MIME type (optional, for <img src>)"""
+        if self.anomaly_image_key:
+            # Annotated images are always encoded as JPEG
+            return "image/jpeg"
         if self.anomalyImage:
             from PIL import Image
             import io
@@ -145,10 +203,200 @@ class RoadAnomalyReport(models.Model):
         return None
 
 
+class MediaContentManager(models.Manager):
+    def store(self, data, content_type):
+        """
+        Store `data` under its SHA-256, or add a reference to the identical
+        blob already stored. Returns the file_id (the hex digest).
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        if self.filter(file_id=digest).update(ref_count=F('ref_count') + 1):
+            return digest
+
+        # The object is written first, so a row never points at a missing one
+        key = storage.put_content('media', data, digest)
+        try:
+            with transaction.atomic():
+                self.create(file_id=digest, sha256=digest, blob_key=key, size=len(data), content_type=content_type, ref_count=1)
+        except IntegrityError:
+            # Stored by a concurrent upload meanwhile
+            self.filter(file_id=digest).update(ref_count=F('ref_count') + 1)
+
+        # put_content skipped the write if the object existed, and garbage
+        # collection may have moved it aside since; see storage.delete_unreferenced
+        storage.put_content('media', data, digest)
+        return digest
+
+    def release(self, file_ids):
+        """Drop one reference per occurrence in `file_ids`; see `collect_garbage`."""
+        counts = Counter(file_ids)
+        for count in set(counts.values()):
+            ids = [file_id for file_id, n in counts.items() if n == count]
+            self.filter(file_id__in=ids).update(ref_count=F('ref_count') - count)
+
+    def recount_references(self):
+        """Recompute every ref_count from the `files` of all reports."""
+        counts = Counter(
+            f['file_id']
+            for files in RoadAnomalyReport.objects.values_list('files', flat=True).iterator(chunk_size=2000)
+            for f in files or []
+        )
+        with transaction.atomic():
+            self.update(ref_count=0)
+            for count in set(counts.values()):
+                ids = [file_id for file_id, n in counts.items() if n == count]
+                for start in range(0, len(ids), 500):
+                    self.filter(file_id__in=ids[start:start + 500]).update(ref_count=count)
+
+    def collect_garbage(self):
+        """
+        Delete blobs no report refers to. Returns the number of rows deleted.
+
+        Each row is locked and its count checked again before it is deleted,
+        so an upload that referenced it meanwhile keeps it. Objects are only
+        deleted once the deletion is committed.
+        """
+        deleted = 0
+        for file_id in self.filter(ref_count__lte=0).values_list('file_id', flat=True):
+            with transaction.atomic():
+                media = self.select_for_update().filter(file_id=file_id, ref_count__lte=0).only('file_id', 'blob_key').first()
+                # Conditional too, for databases without row locks (SQLite)
+                if media is None or not self.filter(file_id=file_id, ref_count__lte=0).delete()[0]:
+                    continue
+                deleted += 1
+
+                if media.blob_key:
+                    # Rows of older uploads may share an object; so may a new upload
+                    transaction.on_commit(functools.partial(
+                        storage.delete_unreferenced, media.blob_key, self.filter(blob_key=media.blob_key).exists,
+                    ))
+        return deleted
+
+
 class MediaContent(models.Model):
+    """
+    An uploaded image or video. New uploads are content-addressed: the
+    file_id is the SHA-256 of the bytes, identical uploads share one row and
+    `ref_count` counts the `files` entries of reports referring to it.
+    Rows of older uploads keep their uuid file_id until `manage.py dedupe_media`.
+
+    The bytes are in the blob store under `blob_key`; rows written before
+    the store keep them in `binary_data` until `manage.py move_blobs_to_store`.
+    """
     file_id = models.CharField(max_length=255, primary_key=True, unique=True)
     binary_data = models.BinaryField(blank=True, null=True)
     content_type = models.TextField(max_length=5, choices=FileTypeChoise.choices, default=FileTypeChoise.IMAGE)
+    sha256 = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    ref_count = models.IntegerField(default=1)
+    blob_key = models.CharField(max_length=100, null=True, blank=True, db_index=True)
+    size = models.BigIntegerField(null=True, blank=True)
+
+    objects = MediaContentManager()
 
     def __str__(self):
         return self.file_id
+
+    def read(self):
+        """
+        The stored bytes: memory-mapped from the blob store (nothing is
+        copied until it is read) or the legacy `binary_data`.
+        """
+        if self.blob_key:
+            return storage.read(self.blob_key)
+        return self.binary_data
+
+    def local_path(self):
+        """File of the blob when the store keeps it locally, else None."""
+        if self.blob_key:
+            store = storage.get_store()
+            if hasattr(store, 'path'):
+                return store.path(self.blob_key)
+        return None
+
+
+@receiver(post_delete, sender=RoadAnomalyReport)
+def release_report_media(sender, instance, **kwargs):
+    MediaContent.objects.release(f['file_id'] for f in instance.files or [])
+
+    key = instance.anomaly_image_key
+    if key:
+        transaction.on_commit(functools.partial(
+            storage.delete_unreferenced, key, RoadAnomalyReport.objects.filter(anomaly_image_key=key).exists,
+        ))
+
+
+class SegmentStatusChoise(models.TextChoices):
+    PENDING = 'Pending'
+    RUNNING = 'Running'
+    DONE = 'Done'
+    ERROR = 'Error'
+
+class VideoSegment(models.Model):
+    """
+    Checkpoint of one time segment of a long uploaded video. Segments are
+    classified independently; a worker leases one by setting `locked_by`
+    and `lease_expires_at`, and a restarted worker skips the finished ones.
+    """
+    report = models.ForeignKey(RoadAnomalyReport, on_delete=models.CASCADE, related_name='video_segments')
+    file_id = models.CharField(max_length=255)
+    index = models.IntegerField()
+    start_frame = models.IntegerField()
+    end_frame = models.IntegerField(null=True, blank=True)
+
+    status = models.TextField(max_length=8, choices=SegmentStatusChoise.choices, default=SegmentStatusChoise.PENDING)
+    locked_by = models.CharField(max_length=255, null=True, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    result = models.JSONField(null=True, blank=True)
+    confidence = models.FloatField(default=0.0)
+    image = models.BinaryField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['report', 'file_id', 'index']
+        constraints = [
+            models.UniqueConstraint(fields=['report', 'file_id', 'index'], name='unique_video_segment'),
+        ]
+
+    def __str__(self):
+        return f"{self.file_id} [{self.index}]"
+
+
+class JobStatusChoise(models.TextChoices):
+    QUEUED = 'Queued'
+    RUNNING = 'Running'
+    DONE = 'Done'
+    FAILED = 'Failed'
+
+class ClassificationJob(models.Model):
+    """
+    Durable classification job of a report, run by `manage.py
+    run_classifier_workers` in `deadline` order. A worker leases a job by setting `locked_by`
+    and `lease_expires_at`; jobs whose lease expired (worker killed) are
+    leased again, up to `max_attempts` attempts in total.
+    """
+    report = models.ForeignKey(RoadAnomalyReport, on_delete=models.CASCADE, related_name='jobs')
+    status = models.TextField(max_length=8, choices=JobStatusChoise.choices, default=JobStatusChoise.QUEUED)
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=3)
+    cost = models.FloatField(default=1.0)
+    # higher runs earlier, see settings.SCHEDULER_PRIORITY_SECONDS
+    priority = models.IntegerField(default=0)
+    # scheduling key: earliest first, see jobs.deadline
+    deadline = models.DateTimeField(default=timezone.now)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=255, null=True, blank=True)
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(null=True, blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_after'], name='job_status_run_after'),
+            models.Index(fields=['status', 'deadline'], name='job_status_deadline'),
+        ]
+
+    def __str__(self):
+        return f"{self.report_id} [{self.status}]"
@@ -0,0 +1,60 @@
+"""
+Bulk reclassification of stored reports, e.g. after retraining best.pt.
+
+`manage.py reclassify` streams report ids from the database and hands
+chunks of them to a process pool. Every worker process loads the model
+once and classifies the reports of a chunk concurrently, so their images
+are batched by the worker's inference service. Workers return the new
+fields; the command writes them with bulk updates.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from road_anomaly_detection import settings
+from road_anomaly_detection_model import pool
+
+
+def init_worker(slot_counter, threads, cpu_sets):
+    # Each worker infers in-process; a nested replica pool would oversubscribe.
+    # Settings were already read while importing this module (and are reused
+    # by django.setup()), so override the attribute rather than the env
+    settings.INFERENCE_PROCESSES = 0
+
+    import django
+    django.setup()
+
+    pool._init_worker(slot_counter, threads, cpu_sets)
+
+
+def classify_chunk(report_ids):
+    """
+    Classify the reports `report_ids` without saving them.
+
+    Returns:
+        List of (report id, fields to update or None, error or None)
+    """
+    from road_anomaly_detection_app.models import RoadAnomalyReport, StatusTypeChoise
+    from road_anomaly_detection_app.tasks import classify_media
+
+    reports = list(RoadAnomalyReport.objects.filter(pk__in=report_ids).only('pk', 'files', 'status'))
+    if not reports:
+        return []
+
+    with ThreadPoolExecutor(max_workers=len(reports), thread_name_prefix='reclassify') as executor:
+        futures = [executor.submit(classify_media, report) for report in reports]
+
+    results = []
+    for report, future in zip(reports, futures):
+        try:
+            fields = future.result()
+        except Exception as e:
+            results.append((report.pk, None, repr(e)))
+            continue
+
+        # Reports that never got a result are ready for review now;
+        # reviewed ones keep their status
+        if report.status in (StatusTypeChoise.PROCESS, StatusTypeChoise.ERROR):
+            fields['status'] = StatusTypeChoise.PENDING
+        else:
+            fields['status'] = report.status
+        results.append((report.pk, fields, None))
+    return results
@@ -0,0 +1,174 @@
+"""
+Blob storage for uploaded media and annotated anomaly images.
+
+The tables keep only keys; the bytes live in an object store. The
+interface mirrors S3's object calls (put_object, get_object, head_object,
+delete_object, list_objects), so a bucket-backed class can replace the
+local one through settings.BLOB_STORE_BACKEND. The local store also
+exposes file paths, which lets views hand files to the web server
+(sendfile) and classification map them into memory instead of copying.
+"""
+import hashlib
+import mmap
+import os
+import re
+import tempfile
+import threading
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+_KEY = re.compile(r'^[A-Za-z0-9_.-]+(/[A-Za-z0-9_.-]+)*$')
+
+
+class FileSystemBlobStore:
+    """
+    Objects as files under `root`, sharded by the first four characters of
+    the key's name (`media/ab12...` is stored as `media/ab/12/ab12...`) so
+    no directory grows past a few thousand entries.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def relative_path(self, key):
+        """Path of `key` relative to the root."""
+        if not _KEY.match(key) or '..' in key.split('/'):
+            raise ValueError(f"Invalid blob key: {key!r}")
+        prefix, _, name = key.rpartition('/')
+        return Path(prefix, name[:2], name[2:4], name)
+
+    def path(self, key):
+        """Local file of `key`, for sendfile and mmap."""
+        return self.root / self.relative_path(key)
+
+    def put_object(self, key, data):
+        """
+        Write `data` under `key` atomically: readers see the old object or
+        the complete new one, never a partial file.
+        """
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        fd, temp_path = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def get_object(self, key):
+        return self.path(key).read_bytes()
+
+    def head_object(self, key):
+        """Size of `key` in bytes, or None if there is no such object."""
+        try:
+            return self.path(key).stat().st_size
+        except FileNotFoundError:
+            return None
+
+    def delete_object(self, key):
+        self.path(key).unlink(missing_ok=True)
+
+    def move_object(self, key, new_key):
+        """Rename `key` to `new_key` atomically. Returns False if there is no `key`."""
+        target = self.path(new_key)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.replace(self.path(key), target)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def modified_at(self, key):
+        """When `key` was last written (POSIX timestamp), or None if there is no such object."""
+        try:
+            return self.path(key).stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+    def list_objects(self, prefix):
+        """Keys of the objects under `prefix` (e.g. 'images')."""
+        base = self.root / prefix
+        for directory, _, files in os.walk(base):
+            for name in files:
+                if not name.startswith('.tmp-'):
+                    yield f"{prefix}/{name}"
+
+    def mmap(self, key):
+        """
+        Read-only memory map of `key`: the pages come from the page cache
+        and nothing is copied into the process until it is read. Empty
+        objects cannot be mapped and come back as b''.
+        """
+        with open(self.path(key), 'rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_store():
+    """The store configured by settings.BLOB_STORE_BACKEND and BLOB_STORE_ROOT."""
+    key = (settings.BLOB_STORE_BACKEND, str(settings.BLOB_STORE_ROOT))
+    if key not in _stores:
+        with _stores_lock:
+            if key not in _stores:
+                _stores[key] = import_string(settings.BLOB_STORE_BACKEND)(settings.BLOB_STORE_ROOT)
+    return _stores[key]
+
+
+def put_content(prefix, data, digest = None):
+    """
+    Store `data` under its SHA-256 below `prefix`; identical data is stored once.
+
+    Returns:
+        The key
+    """
+    key = f"{prefix}/{digest or hashlib.sha256(data).hexdigest()}"
+    store = get_store()
+    if store.head_object(key) != len(data):
+        store.put_object(key, data)
+    return key
+
+
+def delete_unreferenced(key, referenced):
+    """
+    Delete `key` unless `referenced()` finds a row using it.
+
+    The object is moved aside before asking: an upload of the same content
+    meanwhile finds it missing and writes it again (see
+    MediaContentManager.store), and an upload that already saw it has its
+    row in place by the time `referenced()` runs, so the object is put back.
+    Call after the transaction that dropped the last reference commits.
+    """
+    store = get_store()
+    trash = f"trash/{uuid.uuid4().hex}"
+    if not store.move_object(key, trash):
+        return False
+    if referenced():
+        store.move_object(trash, key)
+        return False
+    store.delete_object(trash)
+    return True
+
+
+def read(key):
+    """
+    Contents of `key` for classification: a memoryview of a memory map
+    where the store has local files, else the bytes.
+    """
+    store = get_store()
+    if hasattr(store, 'mmap'):
+        return memoryview(store.mmap(key))
+    return store.get_object(key)
@@ -1,17 +1,26 @@
-from road_anomaly_detection_model.model import *
-from road_anomaly_detection_app.models import RoadAnomalyReport, MediaContent, StatusTypeChoise
+from road_anomaly_detection_model.model import CLASS_NAMES, annotate_image, encode_image, model_version, records_from_result
+from road_anomaly_detection_model.service import get_service
+from road_anomaly_detection_model.timing import timed
+from road_anomaly_detection_model.video import iter_distinct_frames, open_video, plan_segments, prefetch_batches, sample_distinct_frames
+from road_anomaly_detection_app import storage
+from road_anomaly_detection_app.models import RoadAnomalyReport, MediaContent, StatusTypeChoise, SegmentStatusChoise, VideoSegment, JobStatusChoise
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
 # from celery import shared_task
 # from road_anomaly_detection import settings
 
 import logging
 import functools
 import time
+from collections import deque
+from contextlib import closing
+from datetime import timedelta
 from typing import Callable, Any, Optional, Type, Tuple, List, Dict
 import os
 
 import cv2
 
-from uuid import uuid4
 
 # Configure logger (optional)
 logger = logging.getLogger(__name__)
@@ -92,126 +101,293 @@ def try_except(
 #  'main_confidence': 0.6158
 # }
 
-def extract_and_classify_frames(video_path: str,max_frames: int = 10) -> List[Dict]:
+def classify_video(instance: RoadAnomalyReport, video, file_id: str, max_frames: int = 10) -> Tuple[Optional[Dict], Optional[bytes]]:
     """
-    Extract up to `max_frames` evenly spaced frames from video
-    and classify each one.
+    Select up to `max_frames` distinct frames of a video (file path or bytes)
+    and classify them through the shared inference service. Only the sampled
+    candidates are decoded, near-duplicates are dropped before inference and
+    only the winning frame is annotated and encoded.
+
+    Videos longer than settings.VIDEO_SEGMENT_SECONDS are classified segment
+    by segment (`max_frames` each) with every result checkpointed in a VideoSegment.
+
+    Segments are leased one at a time, so finished ones are skipped after a
+    restart, and idle workers lease the others (`classify_next_segment`)
+    while this one works through them.
+    Returns once every segment is done, with the (classifier output,
+    annotated JPEG bytes) of the most confident frame over all of them, or
+    (None, None) if no frame could be read.
     """
-    cap = cv2.VideoCapture(video_path)
-    if not cap.isOpened():
-        raise ValueError(f"Cannot open video: {video_path}")
+    with open_video(video) as cap:
+        segments = plan_segments(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), cap.get(cv2.CAP_PROP_FPS), settings.VIDEO_SEGMENT_SECONDS)
+        if len(segments) == 1:
+            return _annotate_best(_classify_range(cap, file_id, max_frames))
+
+        VideoSegment.objects.bulk_create(
+            [
+                VideoSegment(report=instance, file_id=file_id, index=index, start_frame=start, end_frame=end)
+                for index, (start, end) in enumerate(segments)
+            ],
+            ignore_conflicts=True,
+        )
+        segments = VideoSegment.objects.filter(report=instance, file_id=file_id)
+        # jobs imports this module
+        from road_anomaly_detection_app.jobs import worker_name
+        worker = worker_name()
+
+        while True:
+            segment = _claim_segment(segments, worker)
+            if segment is not None:
+                _classify_segment(cap, segment, worker, max_frames)
+            elif segments.exclude(status=SegmentStatusChoise.DONE).exists():
+                # The rest is leased by other workers
+                time.sleep(settings.VIDEO_SEGMENT_POLL_SECONDS)
+            else:
+                break
 
-    total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    duration = total_frames / fps if fps > 0 else 0
+    best = segments.filter(result__isnull=False).order_by('-confidence', 'index').first()
+    if best is None:
+        return None, None
+    return best.result, bytes(best.image) if best.image is not None else None
 
-    # Choose frame indices evenly
-    if total_frames <= max_frames:
-        frame_indices = range(0, total_frames, max(1, total_frames // max_frames))
-    else:
-        step = total_frames // max_frames
-        frame_indices = range(0, total_frames, step)
 
-    results = []
-    frame_count = 0
+def classify_next_segment(worker: str, max_frames: Optional[int] = None) -> bool:
+    """
+    Classify one segment of a long video whose report another worker is
+    running, so an idle worker shares the work of that video. Failed
+    segments are left to the report's own worker.
+
+    Returns:
+        Whether there was a segment to classify
+    """
+    if max_frames is None:
+        max_frames = settings.VIDEO_MAX_FRAMES
+
+    segments = VideoSegment.objects.filter(report__jobs__status=JobStatusChoise.RUNNING)
+    segment = _claim_segment(segments, worker, retry_failed=False)
+    if segment is None:
+        return False
+
+    media = MediaContent.objects.filter(file_id=segment.file_id).first()
+    if media is None:
+        VideoSegment.objects.filter(pk=segment.pk, locked_by=worker).update(status=SegmentStatusChoise.ERROR, lease_expires_at=None)
+        return True
+
+    with open_video(media.local_path() or media.read()) as cap:
+        _classify_segment(cap, segment, worker, max_frames)
+    return True
+
+
+def _claim_segment(segments, worker: str, retry_failed: bool = True) -> Optional[VideoSegment]:
+    """
+    Lease the first segment that is pending, failed (with `retry_failed`)
+    or whose lease expired. The conditional update makes sure only one
+    worker gets each segment.
+    """
+    now = timezone.now()
+    statuses = [SegmentStatusChoise.PENDING, SegmentStatusChoise.ERROR] if retry_failed else [SegmentStatusChoise.PENDING]
+    claimable = Q(status__in=statuses) | Q(status=SegmentStatusChoise.RUNNING, lease_expires_at__lt=now)
+
+    for pk in segments.filter(claimable).order_by('index').values_list('pk', flat=True):
+        claimed = segments.filter(claimable, pk=pk).update(
+            status=SegmentStatusChoise.RUNNING,
+            locked_by=worker,
+            lease_expires_at=now + timedelta(seconds=settings.VIDEO_SEGMENT_LEASE_SECONDS),
+        )
+        if claimed:
+            return VideoSegment.objects.get(pk=pk)
+    return None
+
+
+def _classify_segment(cap, segment: VideoSegment, worker: str, max_frames: int):
+    try:
+        with timed('video_segment', index=segment.index):
+            best = _classify_range(cap, segment.file_id, max_frames, segment.start_frame, segment.end_frame)
+            result, annotated = _annotate_best(best)
+    except Exception:
+        VideoSegment.objects.filter(pk=segment.pk, locked_by=worker).update(status=SegmentStatusChoise.ERROR, lease_expires_at=None)
+        raise
+
+    # Unless the lease expired and another worker took the segment over
+    saved = VideoSegment.objects.filter(pk=segment.pk, locked_by=worker, status=SegmentStatusChoise.RUNNING).update(
+        result=result,
+        image=annotated,
+        confidence=best[0] if best is not None else 0.0,
+        status=SegmentStatusChoise.DONE,
+        lease_expires_at=None,
+        updated_at=timezone.now(),
+    )
+    if not saved:
+        logger.warning("Lost the lease of video segment %s before it was done", segment.pk)
+
+
+def _classify_range(cap, video_name: str, max_frames: int, start: int = 0, end: Optional[int] = None) -> Optional[Tuple]:
+    """
+    Classify up to `max_frames` distinct frames of [start, end) of an opened
+    capture and return the (score, frame, result) of the best one.
 
-    while True:
-        ret, frame = cap.read()
-        if not ret:
-            break
+    With settings.VIDEO_PIPELINE a decoder thread keeps selecting frames
+    while earlier ones are classified, and only the best frame so far is
+    kept in memory.
+    """
+    best = None
+    if settings.VIDEO_PIPELINE:
+        frames = iter_distinct_frames(cap, max_frames, start=start, end=end)
+        with closing(prefetch_batches(frames, settings.INFERENCE_MAX_BATCH_SIZE, settings.VIDEO_QUEUE_SIZE)) as batches:
+            for batch in batches:
+                best = _best_frame(best, batch, video_name)
+    else:
+        with timed('video_decode'):
+            sampled = sample_distinct_frames(cap, max_frames, start=start, end=end)
+        best = _best_frame(best, sampled, video_name)
+    return best
 
-        if frame_count in frame_indices:
-            frame_path = f"{os.path.splitext(video_path)[0]}_frame_{frame_count}_{uuid4()}.jpg"
-            cv2.imwrite(frame_path, frame)
-            result = classifier(frame_path)
-            results.append(result)
 
-        frame_count += 1
+def _annotate_best(best: Optional[Tuple]) -> Tuple[Optional[Dict], Optional[bytes]]:
+    if best is None:
+        return None, None
 
-        # Optional: stop early if we have enough
-        if len(results) >= max_frames:
-            break
-    cap.release()
+    _, frame, result = best
+    with timed('annotate'):
+        annotated = annotate_image(frame.copy(), records_from_result(result), CLASS_NAMES)
+    with timed('encode'):
+        return result, encode_image(annotated)
 
-    os.remove(video_path)
 
-    return results
+def _best_frame(best: Optional[Tuple], sampled: List[Tuple], video_name: str) -> Optional[Tuple]:
+    """
+    Classify the (frame index, frame) pairs in `sampled` without annotation
+    and return the (score, frame, result) of the most confident frame of
+    them and `best`. Ties keep the earlier frame.
+    """
+    if not sampled:
+        return best
+
+    frames = [frame for _, frame in sampled]
+    frame_names = [f"{video_name}_frame_{index}" for index, _ in sampled]
+
+    with timed('classify', images=len(frames)):
+        results = get_service().classify(frames, image_names=frame_names, annotate=False)
+
+    for frame, (result, _) in zip(frames, results):
+        if result is None:
+            continue
+        score = result.get('main_confidence', 0.0) if result['detections'] else 0.0
+        if best is None or score > best[0]:
+            best = (score, frame, result)
+    return best
+
+
+def _report_entry(file_id: str, result: Dict, annotated: Optional[bytes]) -> Dict:
+    if result['detections']:
+        return {
+            'file_id': file_id,
+            'image': annotated,
+            'class': result['main_class'],
+            'confidence': result['main_confidence']
+        }
+
+    return {
+        'file_id': file_id,
+        'image': annotated,
+        'class': None,
+        'confidence': 0.0
+    }
+
+
+def classify_report(instance: RoadAnomalyReport):
+    """
+    Classify the media of a report and store the result on it.
+    Raises on failure, so job workers can retry.
+    """
+    with timed('data_classifier', report=instance.pk):
+        _classify_report(instance)
 
 
 @try_except
 def data_classifier(instance: RoadAnomalyReport):
-    if RoadAnomalyReport.objects.filter(pk = instance.pk):
-        reports = []
-        for f in instance.files:
-            print(f)
-            if f["file_type"] == "Image":
-                media : MediaContent = MediaContent.objects.get(file_id = f['file_id'])
-                file_path = f'road_anomaly_detection_model/temp/{media.file_id}.jpg'
-                with open(file_path, 'wb') as file:
-                    file.write(media.binary_data)
-
-                result = classifier(file_path)
-                print(result)
-
-                if result['detections']:
-                    reports.append({
-                        'file_id': media.file_id,
-                        'file_path': file_path,
-                        'class': result['main_class'],
-                        'confidence': result['main_confidence']
-                    })
-                
-                else:
-                    reports.append({
-                        'file_id': media.file_id,
-                        'file_path': file_path,
-                        'class': None,
-                        'confidence': 0.0
-                    })
-
-            elif f["file_type"] == "Video":
-                media : MediaContent = MediaContent.objects.get(file_id = f['file_id'])
-                file_path = f'road_anomaly_detection_model/temp/{media.file_id}.mp4'
-                with open(file_path, 'wb') as file:
-                    file.write(media.binary_data)
-
-                results = extract_and_classify_frames(file_path, max_frames=10)
-                print(results)
-                for result in results:
-                    if result['detections']:
-                        reports.append({
-                            'file_id': media.file_id,
-                            'file_path': f'road_anomaly_detection_model/temp/{result["image_name"]}',
-                            'class': result['main_class'],
-                            'confidence': result['main_confidence']
-                        })
-                    else:
-                        reports.append({
-                            'file_id': media.file_id,
-                            'file_path': f'road_anomaly_detection_model/temp/{result["image_name"]}',
-                            'class': None,
-                            'confidence': 0.0
-                        })
-            else:
-                pass
+    classify_report(instance)
 
-        best = max(reports, key=lambda x: x['confidence']) 
-        if best['confidence'] > 0:
-            instance.anomalyType = best['class']
-        else:
-            instance.anomalyType = "No detections found"
 
-        with open(best['file_path'], 'r+b') as file:
-            instance.anomalyImage = file.read()
+def _classify_report(instance: RoadAnomalyReport):
+    if RoadAnomalyReport.objects.filter(pk = instance.pk).exists():
+        fields = classify_media(instance)
+        for name, value in fields.items():
+            setattr(instance, name, value)
 
         instance.status = StatusTypeChoise.PENDING
 
-        instance.save(update_fields=['status', 'anomalyType', 'anomalyImage'])
+        with timed('save'):
+            instance.save(update_fields=['status', *fields])
 
-        for path in reports:
-            os.remove(path['file_path'])
+        # The checkpoints are only needed until the report is classified
+        if any(f["file_type"] == "Video" for f in instance.files):
+            VideoSegment.objects.filter(report = instance).delete()
 
 
-        
+def classify_media(instance: RoadAnomalyReport) -> Dict:
+    """
+    Classify the media of a report without saving it.
 
+    All media rows come from one query, streamed one row at a time. Images
+    go to the shared inference service as they arrive (batched with those
+    of concurrent jobs, decoded straight from the memory-mapped blob) and
+    at most settings.INFERENCE_MAX_BATCH_SIZE of them are in flight, so only
+    a few blobs and the best result so far are held in memory. Videos are
+    opened from their file in the blob store.
 
+    Returns:
+        The anomalyType, annotated image key and size and model_version to
+        store on the report
+    """
+    positions = {f['file_id']: position for position, f in enumerate(instance.files)}
+    file_types = {f['file_id']: f['file_type'] for f in instance.files}
+    service = get_service()
+    pending = deque()
+    best = None
+
+    def keep(position, file_id, result, annotated):
+        nonlocal best
+        logger.debug("Report %s: %s result %s", instance.pk, file_id, result)
+        if result is None:
+            return
+        entry = _report_entry(file_id, result, annotated)
+        # Ties keep the file listed first
+        key = (entry['confidence'], -position)
+        if best is None or key > best[0]:
+            best = (key, entry)
+
+    def wait(position, file_id, future):
+        keep(position, file_id, *future.result())
+
+    with timed('classify', files=len(positions)):
+        media_rows = MediaContent.objects.filter(file_id__in = positions).iterator(chunk_size = 1)
+        for media in media_rows:
+            position = positions[media.file_id]
+            logger.debug("Report %s: classifying %s", instance.pk, media.file_id)
+
+            if file_types[media.file_id] == "Image":
+                pending.append((position, media.file_id, service.submit(media.read(), media.file_id)))
+                while len(pending) > settings.INFERENCE_MAX_BATCH_SIZE:
+                    wait(*pending.popleft())
+
+            elif file_types[media.file_id] == "Video":
+                video = media.local_path() or media.read()
+                result, annotated = classify_video(instance, video, media.file_id, max_frames=settings.VIDEO_MAX_FRAMES)
+                keep(position, media.file_id, result, annotated)
+
+        while pending:
+            wait(*pending.popleft())
+
+    if best is None:
+        raise ValueError(f"No media of report {instance.pk} could be classified")
+
+    _, best = best
+    return {
+        'anomalyType': best['class'] if best['confidence'] > 0 else "No detections found",
+        'anomaly_image_key': storage.put_content('images', best['image']) if best['image'] else None,
+        'anomalyImage': None,
+        'has_image': bool(best['image']),
+        'image_size': len(best['image']) if best['image'] else None,
+        'model_version': model_version(),
+    }
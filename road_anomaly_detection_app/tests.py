@@ -1,3 +1,1006 @@
-from django.test import TestCase
+import hashlib
+import importlib.util
+import io
+import json
+import mmap
+import os
+import pickle
+import sys
+import tempfile
+import unittest
+from concurrent.futures import Future
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from unittest import mock
+
+import cv2
+import numpy as np
+from django.apps import apps
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.http import FileResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
+
+from road_anomaly_detection_app import admission, jobs, reclassify, storage, tasks
+from road_anomaly_detection_app.management.commands import reclassify as reclassify_command
+from road_anomaly_detection_app import views
+from road_anomaly_detection_app.views import AnomalyImageView
+from road_anomaly_detection_app.models import (
+    ClassificationJob, JobStatusChoise, MediaContent, RoadAnomalyReport, SegmentStatusChoise, StatusTypeChoise,
+    VideoSegment,
+)
+from road_anomaly_detection_model import engines, model
+from road_anomaly_detection_model import pool, tiling, timing, video
+from road_anomaly_detection_model.cache import ResultCache
+from road_anomaly_detection_model.service import InferenceService
+from road_anomaly_detection_model.temp import temp
 
 # Create your tests here.
+
+
+def _box_iou(a, b):
+    width = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+    height = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    intersection = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+class NmsTests(SimpleTestCase):
+    def test_overlapping_boxes_of_same_class_are_suppressed(self):
+        boxes = np.array([[0, 0, 10, 10], [1, 1, 10, 10], [20, 20, 30, 30]], dtype=np.float32)
+        scores = np.array([0.9, 0.8, 0.7], dtype=np.float32)
+
+        keep = engines.nms(boxes, scores, iou_threshold=0.5)
+
+        self.assertEqual(keep.tolist(), [0, 2])
+
+    def test_overlapping_boxes_of_different_classes_are_kept(self):
+        boxes = np.array([[0, 0, 10, 10], [1, 1, 10, 10]], dtype=np.float32)
+        scores = np.array([0.9, 0.8], dtype=np.float32)
+        class_ids = np.array([0, 3])
+
+        keep = engines.batched_nms(boxes, scores, class_ids, iou_threshold=0.5)
+
+        self.assertEqual(keep.tolist(), [0, 1])
+
+    def test_postprocess_undoes_letterbox(self):
+        image = np.zeros((480, 640, 3), dtype=np.uint8)
+        _, ratio, pad = engines.letterbox(image, 320)
+
+        # One anchor centred on (160, 160) in network space, 40x20, class 2
+        output = np.zeros((4 + 4, 1), dtype=np.float32)
+        output[:4, 0] = [160, 160, 40, 20]
+        output[4 + 2, 0] = 0.8
+
+        detections = engines.postprocess(output, 0.3, ratio, pad, image.shape[:2])
+
+        self.assertEqual(detections.shape, (1, 6))
+        np.testing.assert_allclose(detections[0], [280, 220, 360, 260, 0.8, 2], atol=1e-4)
+
+
+def _per_box_detections(detections, class_names):
+    """The per-box conversion build_detections used before DETECTION_DTYPE."""
+    output = []
+    for x1, y1, x2, y2, confidence, class_id in detections.tolist():
+        class_id = int(class_id)
+        output.append({
+            "class": class_names.get(class_id, f"Class_{class_id}"),
+            "confidence": round(confidence, 4),
+            "bounding_box": {"x1": int(x1), "y1": int(y1), "x2": int(x2), "y2": int(y2)},
+            "area_pixels": int((x2 - x1) * (y2 - y1)),
+        })
+    return output, max(output, key=lambda x: x['confidence'])
+
+
+class DetectionRecordsTests(SimpleTestCase):
+    class_names = {0: 'D00_Longitudinal_Crack', 1: 'D40_Pothole'}
+
+    def assert_matches_per_box(self, detections):
+        expected, best = _per_box_detections(detections, self.class_names)
+
+        output = model.build_detections(model.to_records(detections), 'image.jpg', self.class_names)
+
+        self.assertEqual(output['detections'], expected)
+        self.assertEqual((output['main_class'], output['main_confidence']), (best['class'], best['confidence']))
+
+    def test_random_detections_match_the_per_box_conversion(self):
+        rng = np.random.default_rng(7)
+        for _ in range(20):
+            count = int(rng.integers(1, 200))
+            # Image-scale boxes: float32 areas of these lose the last pixel
+            x1, y1 = rng.uniform(0, 1000, count), rng.uniform(0, 1000, count)
+            detections = np.stack([
+                x1, y1, x1 + rng.uniform(100, 2800, count), y1 + rng.uniform(100, 2800, count),
+                rng.uniform(0.25, 1, count), rng.integers(0, 3, count),
+            ], axis=1).astype(np.float32)
+
+            self.assert_matches_per_box(detections)
+
+    def test_truncation_rounding_and_ties(self):
+        detections = np.array([
+            # coordinates truncate, the area is truncated after multiplying
+            [10.9, 20.5, 30.99, 41.2, 0.51231, 0],
+            # higher, but the same once rounded: the first box still wins
+            [0, 0, 1, 1, 0.51234, 1],
+            [5, 5, 6.5, 7.5, 0.51226, 2],
+            [1.5, 2.5, 3.5, 4.5, 0.12345, 1],
+        ], dtype=np.float32)
+
+        self.assert_matches_per_box(detections)
+        self.assertEqual(model.build_detections(model.to_records(detections), 'image.jpg', self.class_names)['main_class'], 'D00_Longitudinal_Crack')
+
+
+class TilingTests(SimpleTestCase):
+    def test_tiles_cover_the_image_with_overlap(self):
+        positions = tiling.tile_positions(3840, 640, 0.2)
+
+        self.assertEqual(positions[0], 0)
+        self.assertEqual(positions[-1], 3840 - 640)
+        self.assertTrue(all(b - a <= 512 for a, b in zip(positions, positions[1:])))
+
+    def test_box_split_across_tiles_is_merged(self):
+        detections = np.array([
+            [500, 100, 640, 120, 0.6, 0],   # crack cut at the right border of one tile
+            [512, 100, 800, 121, 0.7, 0],   # the same crack seen by the next tile
+            [520, 100, 600, 120, 0.5, 3],   # different class, kept
+        ], dtype=np.float32)
+
+        merged = tiling.merge_detections(detections)
+
+        self.assertEqual(len(merged), 2)
+        np.testing.assert_allclose(merged[0], [500, 100, 800, 121, 0.7, 0])
+
+
+class TimingTests(SimpleTestCase):
+    def setUp(self):
+        previous = timing.get_sink()
+        self.addCleanup(timing.configure, previous)
+
+    def test_stages_are_recorded_into_the_sink(self):
+        sink = timing.configure('memory')
+
+        with timing.timed('decode'):
+            pass
+
+        @timing.timed('inference')
+        def infer():
+            return 42
+
+        self.assertEqual(infer(), 42)
+        self.assertEqual(sink.summary()['decode']['count'], 1)
+        self.assertEqual(sink.summary()['inference']['count'], 1)
+
+    def test_nothing_is_recorded_when_off(self):
+        timing.configure(None)
+
+        with timing.timed('decode') as timer:
+            pass
+
+        self.assertIsNone(timer._start)
+
+
+def _write_test_video(path, frames = 300):
+    """MJPG video whose frame `i` is filled with the value `i % 256`."""
+    writer = cv2.VideoWriter(str(path), cv2.VideoWriter_fourcc(*'MJPG'), 30, (64, 48))
+    for i in range(frames):
+        writer.write(np.full((48, 64, 3), i % 256, dtype=np.uint8))
+    writer.release()
+
+
+class _UnseekableCapture:
+    """Wraps a capture and refuses to seek, like some streamed containers."""
+
+    def __init__(self, cap):
+        self.cap = cap
+
+    def set(self, prop, value):
+        return False
+
+    def __getattr__(self, name):
+        return getattr(self.cap, name)
+
+
+class VideoSamplingTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = Path(directory.name) / 'video.avi'
+        _write_test_video(self.path)
+
+    def _sample(self, wrap = lambda cap: cap):
+        cap = cv2.VideoCapture(str(self.path))
+        self.addCleanup(cap.release)
+        return [(index, int(round(frame.mean()))) for index, frame in video.sample_frames(wrap(cap), 3)]
+
+    def test_seeks_to_the_sampled_frames(self):
+        self.assertEqual(self._sample(), [(0, 0), (100, 100), (200, 200)])
+
+    def test_falls_back_to_grabbing_when_seeking_fails(self):
+        self.assertEqual(self._sample(_UnseekableCapture), [(0, 0), (100, 100), (200, 200)])
+
+    def test_samples_within_a_frame_range(self):
+        cap = cv2.VideoCapture(str(self.path))
+        self.addCleanup(cap.release)
+
+        self.assertEqual([index for index, _ in video.sample_frames(cap, 3, start=150, end=300)], [150, 200, 250])
+
+    def test_long_videos_are_split_into_segments(self):
+        self.assertEqual(video.plan_segments(300, 30, 4), [(0, 120), (120, 240), (240, 300)])
+        self.assertEqual(video.plan_segments(300, 30, 60), [(0, 300)])
+        self.assertEqual(video.plan_segments(0, 30, 4), [(0, None)])
+
+    def test_opens_video_from_memory(self):
+        with video.open_video_bytes(self.path.read_bytes()) as cap:
+            frames = video.sample_frames(cap, 3)
+
+        self.assertEqual([(index, int(round(frame.mean()))) for index, frame in frames], [(0, 0), (100, 100), (200, 200)])
+
+
+class FrameSelectionTests(SimpleTestCase):
+    def _frame(self, seed):
+        rng = np.random.default_rng(seed)
+        return cv2.resize(rng.integers(0, 256, (8, 9, 3), dtype=np.uint8), (90, 80), interpolation=cv2.INTER_NEAREST)
+
+    def test_near_duplicates_are_dropped(self):
+        still = self._frame(0)
+        noisy = np.clip(still.astype(np.int16) + 2, 0, 255).astype(np.uint8)
+        candidates = [(0, still), (10, noisy), (20, still), (30, self._frame(1))]
+
+        self.assertEqual([index for index, _ in video.select_frames(candidates, 10, threshold=6)], [0, 30])
+
+    def test_high_change_frames_are_preferred(self):
+        a = self._frame(0)
+        b = 255 - a
+        c = b.copy()
+        c[:40] = self._frame(1)[:40]
+        candidates = [(0, a), (10, a), (20, b), (30, b), (40, c)]
+
+        self.assertEqual([index for index, _ in video.select_frames(candidates, 2, threshold=6)], [0, 20])
+
+
+class PrefetchBatchesTests(SimpleTestCase):
+    def test_items_arrive_in_order_in_bounded_batches(self):
+        batches = list(video.prefetch_batches(iter(range(20)), batch_size=4, queue_size=2))
+
+        self.assertEqual([item for batch in batches for item in batch], list(range(20)))
+        self.assertTrue(all(1 <= len(batch) <= 4 for batch in batches))
+
+    def test_decoder_errors_are_raised_in_the_consumer(self):
+        def frames():
+            yield 1
+            raise ValueError("corrupt frame")
+
+        with self.assertRaises(ValueError):
+            list(video.prefetch_batches(frames(), batch_size=4))
+
+    def test_closing_stops_the_decoder(self):
+        produced = []
+
+        def frames():
+            for i in range(1000):
+                produced.append(i)
+                yield i
+
+        batches = video.prefetch_batches(frames(), batch_size=1, queue_size=2)
+        next(batches)
+        batches.close()
+
+        self.assertLess(len(produced), 10)
+
+
+class JobSchedulingTests(SimpleTestCase):
+    def setUp(self):
+        self.now = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+    @override_settings(SCHEDULER_SECONDS_PER_COST=2)
+    def test_photos_overtake_an_earlier_video(self):
+        video = jobs.deadline(self.now, cost=100)
+        photo = jobs.deadline(self.now + timedelta(seconds=30), cost=1)
+
+        self.assertLess(photo, video)
+
+    @override_settings(SCHEDULER_SECONDS_PER_COST=2)
+    def test_a_waiting_video_is_not_starved(self):
+        video = jobs.deadline(self.now, cost=100)
+        photo = jobs.deadline(self.now + timedelta(seconds=300), cost=1)
+
+        self.assertLess(video, photo)
+
+    @override_settings(SCHEDULER_SECONDS_PER_COST=2, SCHEDULER_PRIORITY_SECONDS=600)
+    def test_priority_jobs_run_first(self):
+        self.assertLess(jobs.deadline(self.now, cost=100, priority=1), jobs.deadline(self.now, cost=1))
+
+
+class ScratchSpaceTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = Path(directory.name)
+        for name, value in (('MODEL_MEDIA_ROOT', self.root), ('SCRATCH_ON_TMPFS', False), ('SCRATCH_QUOTA_BYTES', 1000)):
+            patcher = mock.patch.object(temp.settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_workspace_is_removed_when_the_job_fails(self):
+        with self.assertRaises(RuntimeError):
+            with temp.workspace('report-1') as scratch:
+                scratch.write('video.mp4', b'x' * 10)
+                raise RuntimeError
+
+        self.assertEqual(list(self.root.iterdir()), [])
+
+    def test_writes_over_the_quota_are_refused(self):
+        with temp.workspace() as scratch:
+            scratch.write('a.jpg', b'x' * 600)
+            with self.assertRaises(temp.ScratchQuotaExceeded):
+                scratch.write('b.jpg', b'x' * 600)
+
+    def test_sweep_removes_only_stale_scratch_entries(self):
+        (self.root / 'job-old').mkdir()
+        (self.root / 'job-old' / 'video.mp4').write_bytes(b'x' * 10)
+        (self.root / 'leaked.mp4').write_bytes(b'x' * 10)
+        (self.root / 'temp.py').write_text('')
+        (self.root / 'job-new').mkdir()
+        for path in (self.root / 'job-old', self.root / 'leaked.mp4', self.root / 'temp.py'):
+            os.utime(path, (0, 0))
+
+        self.assertEqual(temp.sweep(max_age=60), (2, 20))
+        self.assertEqual(sorted(path.name for path in self.root.iterdir()), ['job-new', 'temp.py'])
+
+
+class ResultCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache = ResultCache(Path(directory.name) / 'cache.sqlite3', max_bytes=300)
+        self.addCleanup(self.cache._connection.close)
+
+    def test_key_depends_on_content_version_and_threshold(self):
+        key = ResultCache.make_key(b'image', 'torch-abc', 0.3)
+
+        self.assertEqual(key, ResultCache.make_key(b'image', 'torch-abc', 0.3))
+        self.assertNotEqual(key, ResultCache.make_key(b'other', 'torch-abc', 0.3))
+        self.assertNotEqual(key, ResultCache.make_key(b'image', 'onnx-abc', 0.3))
+        self.assertNotEqual(key, ResultCache.make_key(b'image', 'torch-abc', 0.5))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        result = {'image_name': None, 'detections': None}
+        self.cache.put('a', result, b'x' * 100)
+        self.cache.put('b', result, b'x' * 100)
+        self.cache.get('a')
+        self.cache.put('c', result, b'x' * 100)
+
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('a'), (result, b'x' * 100))
+        self.assertEqual(self.cache.stats()['hits'], 2)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+
+class _StubEngine:
+    """One full-image box per image, as confident as the image is bright."""
+
+    def __init__(self):
+        self.calls = []
+
+    def predict(self, images, conf, imgsz):
+        self.calls.append(len(images))
+        return [
+            np.array([[0, 0, image.shape[1], image.shape[0], image.mean() / 255, 0]], dtype=np.float32)
+            for image in images
+        ]
+
+
+def _gray(value):
+    return np.full((32, 48, 3), value, dtype=np.uint8)
+
+
+class ClassifyBatchTests(SimpleTestCase):
+    def setUp(self):
+        self.engine = _StubEngine()
+
+    def classify(self, images, **kwargs):
+        return model.classify_batch(images, model=self.engine, use_cache=False, tiled=False, **kwargs)
+
+    def test_chunks_keep_the_order_of_the_images(self):
+        images = [_gray(51), _gray(102), b'not an image', _gray(153), _gray(204)]
+
+        outputs = self.classify(images, batch_size=2, image_names=['a', 'b', 'c', 'd', 'e'])
+
+        # The undecodable image leaves its chunk one image short
+        self.assertEqual(self.engine.calls, [2, 1, 1])
+        self.assertEqual(outputs[2], (None, None))
+        self.assertEqual(
+            [(result['image_name'], result['main_confidence']) for result, _ in outputs if result is not None],
+            [('a', 0.2), ('b', 0.4), ('d', 0.6), ('e', 0.8)],
+        )
+
+    def test_annotated_images_are_optional(self):
+        image = _gray(128)
+
+        (_, annotated), = self.classify([image])
+        (result, skipped), = self.classify([image], annotate=False)
+
+        self.assertEqual(annotated[:2], b'\xff\xd8')
+        self.assertIsNone(skipped)
+        self.assertEqual(result['main_class'], model.CLASS_NAMES[0])
+        # The caller's frame is not drawn on
+        self.assertTrue((image == 128).all())
+
+
+class ClassifyBatchCacheTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cache = ResultCache(Path(directory.name) / 'cache.sqlite3', max_bytes=10 ** 6)
+        self.addCleanup(cache._connection.close)
+        self.version = 'torch-abc'
+        for patcher in (
+            mock.patch.object(model, 'get_cache', lambda: cache),
+            mock.patch.object(model, 'model_version', lambda: self.version),
+            mock.patch.object(model.settings, 'MODEL_CONF_THRESHOLD', 0.3),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.engine = _StubEngine()
+        self.image = model.encode_image(_gray(128))
+
+    def classify(self, name):
+        return model.classify_batch([self.image], model=self.engine, image_names=[name], tiled=False)[0]
+
+    def test_repeated_images_skip_the_engine(self):
+        first = self.classify('first')
+        second = self.classify('second')
+
+        self.assertEqual(self.engine.calls, [1])
+        self.assertEqual(second[0]['image_name'], 'second')
+        self.assertEqual(second[0]['detections'], first[0]['detections'])
+        self.assertEqual(second[1], first[1])
+
+    def test_a_new_model_or_threshold_misses_the_cache(self):
+        self.classify('first')
+
+        self.version = 'torch-def'
+        self.classify('new model')
+        with mock.patch.object(model.settings, 'MODEL_CONF_THRESHOLD', 0.5):
+            self.classify('new threshold')
+
+        self.assertEqual(self.engine.calls, [1, 1, 1])
+
+
+class InferenceServiceTests(SimpleTestCase):
+    def test_concurrent_submissions_share_one_batch(self):
+        calls = []
+
+        def runner(images, image_names, annotate, batch_size):
+            calls.append(list(images))
+            return [({'image_name': name}, None) for name in image_names]
+
+        service = InferenceService(max_batch_size=4, max_wait=0.5, runner=runner)
+        futures = [service.submit(i, image_name=f'img-{i}') for i in range(4)]
+
+        self.assertEqual([future.result(timeout=2)[0]['image_name'] for future in futures],
+                         ['img-0', 'img-1', 'img-2', 'img-3'])
+        self.assertEqual(calls, [[0, 1, 2, 3]])
+
+    def test_runner_errors_reach_every_caller(self):
+        def runner(images, image_names, annotate, batch_size):
+            raise RuntimeError('boom')
+
+        service = InferenceService(max_batch_size=2, max_wait=0.01, runner=runner)
+
+        with self.assertRaises(RuntimeError):
+            service.classify([b'a', b'b'])
+
+
+def _stub_classify(images, image_names, annotate, batch_size):
+    return [({'image_name': name}, bytes(image)) for image, name in zip(images, image_names)]
+
+
+class _PicklingPool:
+    """Runs submissions in-process after a pickle round trip, like a process pool."""
+
+    def submit(self, fn, *args):
+        fn, args = pickle.loads(pickle.dumps((fn, args)))
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+class ReplicaPoolTests(SimpleTestCase):
+    @mock.patch.object(pool, '_classify', _stub_classify)
+    @mock.patch.object(pool, 'get_pool', _PicklingPool)
+    def test_memory_mapped_blobs_reach_the_replicas(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(b'jpeg')
+            f.flush()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                results = pool.classify_in_pool([view, b'png'], image_names=['a', 'b'])
+                view.release()
+
+        self.assertEqual([annotated for _, annotated in results], [b'jpeg', b'png'])
+
+
+class AppTablesMixin:
+    """
+    Migrations are generated at deploy time (see app.py), so create the
+    tables of the app's models when the test database lacks them.
+    Blobs go to a temporary store.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        existing = connection.introspection.table_names()
+        with connection.schema_editor() as editor:
+            for model in apps.get_app_config('road_anomaly_detection_app').get_models():
+                if model._meta.db_table not in existing:
+                    editor.create_model(model)
+        super().setUpClass()
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.blob_root = Path(directory.name)
+        override = override_settings(BLOB_STORE_ROOT=self.blob_root)
+        override.enable()
+        self.addCleanup(override.disable)
+
+
+class AppTablesTestCase(AppTablesMixin, TestCase):
+    pass
+
+
+class _FakeService:
+    """Finds a pothole in every image, as confident as its size in bytes / 1000."""
+
+    def submit(self, image, image_name = None, annotate = True):
+        confidence = len(image) / 1000
+        future = Future()
+        future.set_result(({
+            'image_name': image_name,
+            'detections': [{'class': 'D40_Pothole', 'confidence': confidence}],
+            'main_class': 'D40_Pothole',
+            'main_confidence': confidence,
+        }, image))
+        return future
+
+
+@mock.patch.object(tasks, 'model_version', lambda: 'torch-test')
+@mock.patch.object(tasks, 'get_service', _FakeService)
+class ClassifyReportTests(AppTablesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.files = []
+        for i in range(20):
+            file_id = MediaContent.objects.store(b'x' * (100 + i * (i % 3)), 'Image')
+            self.files.append({'file_type': 'Image', 'file_id': file_id})
+
+        self.report = RoadAnomalyReport.objects.create(register='r', roadname='road', geolocation={}, files=self.files)
+
+    def test_media_is_fetched_in_one_query(self):
+        # existence check, media, save
+        with self.assertNumQueries(3):
+            tasks.classify_report(self.report)
+
+        self.report.refresh_from_db()
+        self.assertEqual(self.report.status, StatusTypeChoise.PENDING)
+        self.assertEqual(self.report.anomalyType, 'D40_Pothole')
+        self.assertEqual(self.report.get_image_bytes(), b'x' * (100 + 17 * 2))
+        self.assertEqual((self.report.has_image, self.report.image_size), (True, 100 + 17 * 2))
+        self.assertEqual(self.report.model_version, 'torch-test')
+
+
+@override_settings(VIDEO_SEGMENT_SECONDS=4)
+class VideoSegmentTests(AppTablesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.report = RoadAnomalyReport.objects.create(register='r', roadname='road', geolocation={}, files=[])
+        # 10 s at 30 fps: segments [0, 120), [120, 240), [240, 300)
+        self.path = self.blob_root / 'video.avi'
+        _write_test_video(self.path)
+        self.classified = []
+
+        def classify_range(cap, video_name, max_frames, start = 0, end = None):
+            self.classified.append((start, end))
+            return None
+
+        patcher = mock.patch.object(tasks, '_classify_range', classify_range)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def segment(self, index, status = SegmentStatusChoise.PENDING, report = None, file_id = 'video', **fields):
+        start = index * 120
+        return VideoSegment.objects.create(
+            report=report or self.report, file_id=file_id, index=index,
+            start_frame=start, end_frame=min(start + 120, 300), status=status, **fields
+        )
+
+    def test_a_segment_is_claimed_by_one_worker(self):
+        self.segment(0)
+        self.segment(1)
+        segments = VideoSegment.objects.filter(report=self.report)
+
+        self.assertEqual(tasks._claim_segment(segments, 'worker-a').index, 0)
+        self.assertEqual(tasks._claim_segment(segments, 'worker-b').index, 1)
+        self.assertIsNone(tasks._claim_segment(segments, 'worker-c'))
+
+    def test_expired_leases_are_taken_over(self):
+        self.segment(0, SegmentStatusChoise.RUNNING, locked_by='worker-a', lease_expires_at=now() + timedelta(minutes=5))
+        self.segment(1, SegmentStatusChoise.RUNNING, locked_by='worker-a', lease_expires_at=now() - timedelta(seconds=1))
+
+        segment = tasks._claim_segment(VideoSegment.objects.filter(report=self.report), 'worker-b')
+
+        self.assertEqual((segment.index, segment.locked_by), (1, 'worker-b'))
+
+    def test_a_restarted_worker_resumes_after_done_segments(self):
+        result = {'image_name': 'video', 'detections': [], 'main_confidence': 0.9}
+        self.segment(0, SegmentStatusChoise.DONE, result=result, confidence=0.9, image=b'jpeg')
+
+        self.assertEqual(tasks.classify_video(self.report, self.path, 'video', max_frames=2), (result, b'jpeg'))
+        self.assertEqual(self.classified, [(120, 240), (240, 300)])
+        self.assertFalse(VideoSegment.objects.exclude(status=SegmentStatusChoise.DONE).exists())
+
+    def test_idle_workers_help_with_videos_being_classified(self):
+        file_id = MediaContent.objects.store(self.path.read_bytes(), 'Video')
+        ClassificationJob.objects.create(report=self.report, status=JobStatusChoise.RUNNING)
+        self.segment(0, SegmentStatusChoise.ERROR, file_id=file_id)
+        self.segment(1, file_id=file_id)
+        # Not being classified by anyone
+        idle = RoadAnomalyReport.objects.create(register='r', roadname='road', geolocation={}, files=[])
+        self.segment(0, report=idle, file_id=file_id)
+
+        self.assertTrue(tasks.classify_next_segment('helper'))
+        self.assertFalse(tasks.classify_next_segment('helper'))
+
+        self.assertEqual(self.classified, [(120, 240)])
+        self.assertEqual(VideoSegment.objects.get(report=self.report, index=1).status, SegmentStatusChoise.DONE)
+
+
+@override_settings(
+    ADMISSION_DEFER_WATERMARK=10, ADMISSION_REJECT_WATERMARK=20,
+    ADMISSION_COST_PER_SECOND=1, ADMISSION_BYTES_PER_COST=10 ** 12,
+)
+class AdmissionTests(AppTablesTestCase):
+    def setUp(self):
+        super().setUp()
+        report = RoadAnomalyReport.objects.create(register='r', roadname='road', geolocation={}, files=[])
+        jobs.enqueue(report, cost=8)
+        self.user = mock.Mock(is_authenticated=True, is_staff=False, email='user@example.com')
+        self.user.name = 'user'
+
+    def upload(self):
+        request = RequestFactory().post('/report', {
+            'areaname': 'area', 'pincode': '700001', 'roadname': 'road', 'geolocation': '22.5, 88.3',
+            'instruction': '', 'files': SimpleUploadedFile('pothole.jpg', b'jpeg'),
+        }, HTTP_ACCEPT='application/json')
+        request.user = self.user
+        return views.upload_anomaly_report_page(request)
+
+    def test_watermarks(self):
+        self.assertEqual(admission.admit(2), admission.Decision(admission.RUN, 2, 0))
+        self.assertEqual(admission.admit(5), admission.Decision(admission.DEFER, 5, 13))
+        # Only clients that understand 429 are turned away
+        self.assertEqual(admission.admit(15), admission.Decision(admission.DEFER, 15, 23))
+        self.assertEqual(admission.admit(15, can_reject=True), admission.Decision(admission.REJECT, 15, 23))
+
+    @override_settings(ADMISSION_DEFER_WATERMARK=5)
+    def test_deferred_uploads_run_after_the_backlog_drains(self):
+        before = now()
+
+        response = self.upload()
+
+        body = json.loads(response.content)
+        self.assertEqual((response.status_code, body['status'], body['retry_after']), (202, admission.DEFER, 10))
+        job = ClassificationJob.objects.get(report=body['report'])
+        self.assertGreaterEqual(job.run_after, before + timedelta(seconds=10))
+
+    @override_settings(ADMISSION_DEFER_WATERMARK=5, ADMISSION_REJECT_WATERMARK=8)
+    def test_api_uploads_are_rejected_past_the_reject_watermark(self):
+        response = self.upload()
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '10')
+        self.assertEqual(RoadAnomalyReport.objects.count(), 1)
+
+    def test_queue_depth_needs_a_login(self):
+        request = RequestFactory().get('/queue')
+        request.user = AnonymousUser()
+
+        self.assertEqual(views.queue_depth(request).status_code, 302)
+
+        request.user = self.user
+        self.assertEqual(json.loads(views.queue_depth(request).content)['backlog_cost'], 8)
+
+
+class JobQueueTests(AppTablesTestCase):
+    def setUp(self):
+        super().setUp()
+        self.report = RoadAnomalyReport.objects.create(register='r', roadname='road', geolocation={}, files=[])
+        self.job = jobs.enqueue(self.report, cost=1)
+
+    def expire_lease(self):
+        ClassificationJob.objects.filter(pk=self.job.pk).update(lease_expires_at=now() - timedelta(seconds=1))
+
+    def test_a_job_is_leased_by_one_worker(self):
+        leased = jobs.lease('worker-a')
+
+        self.assertEqual((leased.pk, leased.locked_by, leased.attempts), (self.job.pk, 'worker-a', 1))
+        self.assertIsNone(jobs.lease('worker-b'))
+
+    @override_settings(CLASSIFIER_JOB_RETRY_DELAY_SECONDS=30)
+    def test_failed_attempts_back_off(self):
+        jobs.lease('worker-a')
+        job = ClassificationJob.objects.get()
+        before = now()
+
+        jobs.fail(job, 'boom')
+
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.last_error), (JobStatusChoise.QUEUED, 'boom'))
+        self.assertGreaterEqual(job.run_after, before + timedelta(seconds=30))
+        self.assertIsNone(jobs.lease('worker-b'))
+
+    def test_report_errors_after_the_last_attempt(self):
+        ClassificationJob.objects.filter(pk=self.job.pk).update(max_attempts=1)
+
+        jobs.fail(jobs.lease('worker-a'), 'boom')
+
+        self.assertEqual(ClassificationJob.objects.get().status, JobStatusChoise.FAILED)
+        self.report.refresh_from_db()
+        self.assertEqual(self.report.status, StatusTypeChoise.ERROR)
+
+    def test_expired_leases_are_leased_again_until_attempts_run_out(self):
+        ClassificationJob.objects.filter(pk=self.job.pk).update(max_attempts=2)
+        jobs.lease('worker-a')
+        self.expire_lease()
+
+        leased = jobs.lease('worker-b')
+        self.assertEqual((leased.locked_by, leased.attempts), ('worker-b', 2))
+
+        # worker-b is killed too: no third attempt
+        self.expire_lease()
+        self.assertIsNone(jobs.lease('worker-c'))
+        self.assertEqual(ClassificationJob.objects.get().status, JobStatusChoise.FAILED)
+        self.report.refresh_from_db()
+        self.assertEqual(self.report.status, StatusTypeChoise.ERROR)
+
+
+@mock.patch.object(tasks, 'model_version', lambda: 'torch-test')
+@mock.patch.object(tasks, 'get_service', _FakeService)
+class ReclassifyTests(AppTablesMixin, TransactionTestCase):
+    # classify_chunk reads the reports from worker threads, which do not
+    # see rows of an uncommitted test transaction
+    def setUp(self):
+        super().setUp()
+        files = [{'file_type': 'Image', 'file_id': MediaContent.objects.store(b'x' * 100, 'Image')}]
+        self.new = RoadAnomalyReport.objects.create(register='r', roadname='road', geolocation={}, files=files)
+        self.reviewed = RoadAnomalyReport.objects.create(
+            register='r', roadname='road', geolocation={}, files=files, status=StatusTypeChoise.RESOLVE,
+        )
+        self.broken = RoadAnomalyReport.objects.create(register='r', roadname='road', geolocation={}, files=[])
+
+    def test_chunk_reports_fields_and_errors(self):
+        results = {pk: (fields, error) for pk, fields, error in reclassify.classify_chunk([self.new.pk, self.reviewed.pk, self.broken.pk])}
+
+        self.assertEqual(results[self.new.pk][0]['status'], StatusTypeChoise.PENDING)
+        self.assertEqual(results[self.reviewed.pk][0]['status'], StatusTypeChoise.RESOLVE)
+        self.assertEqual(results[self.new.pk][0]['model_version'], 'torch-test')
+        self.assertIsNone(results[self.broken.pk][0])
+        self.assertIn('ValueError', results[self.broken.pk][1])
+
+    def test_finish_writes_results_and_moves_checkpoint(self):
+        future = Future()
+        future.set_result(reclassify.classify_chunk([self.new.pk, self.broken.pk]))
+        checkpoint = {'selection': {}, 'last_pk': None, 'done': 0, 'failed': []}
+        path = self.blob_root / 'checkpoint.json'
+
+        command = reclassify_command.Command(stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertEqual(command.finish((self.broken.pk, future), checkpoint, path), (1, 1))
+
+        self.assertEqual(json.loads(path.read_text()), {'selection': {}, 'last_pk': self.broken.pk, 'done': 1, 'failed': [self.broken.pk]})
+        self.new.refresh_from_db()
+        self.assertEqual((self.new.anomalyType, self.new.model_version), ('D40_Pothole', 'torch-test'))
+
+    def test_workers_never_start_their_own_replica_pool(self):
+        from road_anomaly_detection import settings as project_settings
+
+        with mock.patch.object(project_settings, 'INFERENCE_PROCESSES', 4), \
+                mock.patch('django.setup'), mock.patch.object(pool, '_init_worker'):
+            reclassify.init_worker(None, 1, [None])
+            self.assertEqual(project_settings.INFERENCE_PROCESSES, 0)
+
+
+class MediaStorageTests(AppTablesTestCase):
+    def test_identical_uploads_share_one_blob(self):
+        first = MediaContent.objects.store(b'pothole', 'Image')
+        second = MediaContent.objects.store(b'pothole', 'Image')
+
+        self.assertEqual(first, second)
+        media = MediaContent.objects.get()
+        self.assertEqual(media.ref_count, 2)
+        self.assertIsNone(media.binary_data)
+        self.assertEqual(bytes(media.read()), b'pothole')
+
+    def test_unreferenced_blobs_are_collected(self):
+        file_id = MediaContent.objects.store(b'pothole', 'Image')
+        report = RoadAnomalyReport.objects.create(
+            register='r', roadname='road', geolocation={}, files=[{'file_type': 'Image', 'file_id': file_id}],
+        )
+
+        with self.captureOnCommitCallbacks(execute=True):
+            report.delete()
+            self.assertEqual(MediaContent.objects.collect_garbage(), 1)
+
+        self.assertFalse(MediaContent.objects.exists())
+        self.assertEqual(list(storage.get_store().list_objects('media')), [])
+
+    def test_anomaly_image_is_served_from_the_store(self):
+        key = storage.put_content('images', b'jpeg')
+        report = RoadAnomalyReport.objects.create(
+            register='r', roadname='road', geolocation={}, files=[], anomaly_image_key=key,
+        )
+
+        response = AnomalyImageView().get(None, report.pk)
+
+        self.assertIsInstance(response, FileResponse)
+        self.assertEqual(b''.join(response.streaming_content), b'jpeg')
+        response.close()
+
+    def test_report_pages_do_not_select_images(self):
+        legacy = RoadAnomalyReport.objects.create(
+            register='r', roadname='road', geolocation={'lat': 1, 'lng': 2}, files=[], anomalyImage=b'jpeg',
+        )
+        stored = RoadAnomalyReport.objects.create(
+            register='r', roadname='road', geolocation={'lat': 1, 'lng': 2}, files=[],
+            anomaly_image_key=storage.put_content('images', b'jpeg'),
+        )
+        none = RoadAnomalyReport.objects.create(register='r', roadname='road', geolocation={'lat': 1, 'lng': 2}, files=[])
+        request = RequestFactory().get('/')
+        request.user = mock.Mock(is_authenticated=True)
+
+        pages = [(None, lambda: views.view_reports_page(request))] + [
+            (report, lambda pk=report.pk: views.report_detailed_view_page(request, pk)) for report in (legacy, stored, none)
+        ]
+        # The map is not what is tested (and plotly express needs pandas)
+        plotly = {'plotly.express': mock.Mock(), 'plotly.io': mock.Mock(to_html=lambda *args, **kwargs: '')}
+        for report, render in pages:
+            with CaptureQueriesContext(connection) as queries, mock.patch.dict(sys.modules, plotly):
+                response = render()
+
+            self.assertEqual(response.status_code, 200)
+            for query in queries:
+                # Testing for NULL is fine, reading the column is not
+                self.assertNotIn('"anomalyImage"', query['sql'].replace('"anomalyImage" IS NOT NULL', ''))
+            if report is not None:
+                self.assertEqual(f'/view/{report.pk}/image/' in response.content.decode(), report is not none)
+
+
+class MoveBlobsToStoreTests(AppTablesTestCase):
+    def test_inline_blobs_move_to_the_store_once(self):
+        MediaContent.objects.create(file_id='legacy-1', binary_data=b'video')
+        report = RoadAnomalyReport.objects.create(
+            register='r', roadname='road', geolocation={}, files=[{'file_type': 'Video', 'file_id': 'legacy-1'}],
+            anomalyImage=b'jpeg',
+        )
+
+        call_command('move_blobs_to_store', stdout=io.StringIO())
+
+        media = MediaContent.objects.get()
+        self.assertIsNone(media.binary_data)
+        self.assertEqual((media.blob_key, media.size), (f"media/{hashlib.sha256(b'video').hexdigest()}", 5))
+        self.assertEqual(storage.get_store().get_object(media.blob_key), b'video')
+        report.refresh_from_db()
+        self.assertIsNone(report.anomalyImage)
+        self.assertEqual((report.has_image, report.image_size), (True, 4))
+        self.assertEqual(storage.get_store().get_object(report.anomaly_image_key), b'jpeg')
+
+        out = io.StringIO()
+        call_command('move_blobs_to_store', stdout=out)
+
+        self.assertIn("Moved 0 media blobs", out.getvalue())
+        self.assertIn("Moved 0 anomaly images", out.getvalue())
+        self.assertIn("Recorded the size of 0 stored images", out.getvalue())
+
+
+class MediaGarbageTests(AppTablesTestCase):
+    def report(self, *file_ids, **fields):
+        files = [{'file_type': 'Image', 'file_id': file_id} for file_id in file_ids]
+        return RoadAnomalyReport.objects.create(register='r', roadname='road', geolocation={}, files=files, **fields)
+
+    def test_gc_media_keeps_what_reports_use(self):
+        store = storage.get_store()
+        kept = MediaContent.objects.store(b'kept', 'Image')
+        orphan = MediaContent.objects.store(b'orphan', 'Image')
+        MediaContent.objects.release([orphan])
+        used = storage.put_content('images', b'used')
+        self.report(kept, anomaly_image_key=used)
+        old = storage.put_content('images', b'old')
+        os.utime(store.path(old), (0, 0))
+        fresh = storage.put_content('images', b'fresh')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('gc_media', '--images', stdout=io.StringIO())
+
+        self.assertEqual(list(MediaContent.objects.values_list('file_id', flat=True)), [kept])
+        self.assertEqual(list(store.list_objects('media')), [f'media/{kept}'])
+        self.assertEqual(sorted(store.list_objects('images')), sorted([used, fresh]))
+
+    def test_blobs_stay_when_the_collection_rolls_back(self):
+        orphan = MediaContent.objects.store(b'orphan', 'Image')
+        MediaContent.objects.release([orphan])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(RuntimeError), transaction.atomic():
+                MediaContent.objects.collect_garbage()
+                raise RuntimeError
+
+        self.assertEqual(bytes(MediaContent.objects.get().read()), b'orphan')
+
+    def test_uploads_racing_the_collection_keep_their_blob(self):
+        orphan = MediaContent.objects.store(b'orphan', 'Image')
+        MediaContent.objects.release([orphan])
+        with self.captureOnCommitCallbacks() as callbacks:
+            MediaContent.objects.collect_garbage()
+
+        # Stored again before the object is deleted: put_content skips the write
+        MediaContent.objects.store(b'orphan', 'Image')
+        callbacks[0]()
+        self.assertEqual(bytes(MediaContent.objects.get().read()), b'orphan')
+
+        # Stored again while the object is moved aside: it is written again
+        MediaContent.objects.release([orphan])
+        MediaContent.objects.filter(file_id=orphan).delete()
+        def upload_meanwhile():
+            MediaContent.objects.store(b'orphan', 'Image')
+            return MediaContent.objects.filter(blob_key=f'media/{orphan}').exists()
+
+        self.assertFalse(storage.delete_unreferenced(f'media/{orphan}', upload_meanwhile))
+        self.assertEqual(bytes(MediaContent.objects.get().read()), b'orphan')
+
+    def test_dedupe_media_merges_legacy_copies(self):
+        MediaContent.objects.create(file_id='legacy-1', binary_data=b'same')
+        MediaContent.objects.create(file_id='legacy-2', binary_data=b'same')
+        MediaContent.objects.create(file_id='legacy-3', binary_data=b'unused')
+        report = self.report('legacy-1', 'legacy-2')
+        digest = hashlib.sha256(b'same').hexdigest()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('dedupe_media', stdout=io.StringIO())
+
+        report.refresh_from_db()
+        self.assertEqual([f['file_id'] for f in report.files], [digest, digest])
+        self.assertEqual(list(MediaContent.objects.values_list('file_id', 'ref_count')), [(digest, 2)])
+        self.assertEqual(bytes(MediaContent.objects.get().binary_data), b'same')
+
+
+@unittest.skipUnless(
+    importlib.util.find_spec('ultralytics') and importlib.util.find_spec('onnxruntime')
+    and settings.MODEL_WEIGHTS.exists() and settings.MODEL_ONNX_WEIGHTS.exists(),
+    "needs ultralytics, onnxruntime and both exported weights"
+)
+class EngineEquivalenceTests(SimpleTestCase):
+    images = ['static/download.jpg', 'static/annotated_1.jpg']
+
+    def test_onnx_detections_match_torch(self):
+        torch_engine = engines.TorchEngine(settings.MODEL_WEIGHTS)
+        onnx_engine = engines.OnnxEngine(settings.MODEL_ONNX_WEIGHTS)
+        images = [cv2.imread(str(settings.BASE_DIR / path)) for path in self.images]
+
+        for expected, actual in zip(torch_engine.predict(images, imgsz=settings.MODEL_IMGSZ),
+                                    onnx_engine.predict(images, imgsz=settings.MODEL_IMGSZ)):
+            # Boxes close to the threshold may flip either way; compare confident ones
+            expected = expected[expected[:, 4] >= 0.4]
+            for box in expected:
+                matches = [
+                    other for other in actual
+                    if int(other[5]) == int(box[5]) and _box_iou(box, other) >= 0.9
+                ]
+                self.assertTrue(matches, f"no ONNX match for {box.tolist()}")
+                self.assertAlmostEqual(float(matches[0][4]), float(box[4]), delta=0.05)
@@ -13,6 +13,7 @@ urlpatterns = [
     path('view', views.view_reports_page, name="viewReport"),
     path('view/<int:report_id>', views.report_detailed_view_page, name="detailedViewReport"),
     path('view/<int:report_id>/image/', views.AnomalyImageView.as_view(), name='anomaly_image'),
+    path('queue', views.queue_depth, name='queueDepth'),
     
     
     path('404', views.custom_404, name='custom_404'),
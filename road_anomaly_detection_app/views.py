@@ -1,5 +1,6 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse, HttpResponse, Http404
+from django.conf import settings
+from django.http import FileResponse, JsonResponse, HttpResponse, Http404
 from django.views.decorators.http import require_POST
 from django.views import View
 from django.contrib.auth.decorators import login_required
@@ -11,12 +12,10 @@ from road_anomaly_detection_app.forms import *
 from road_anomaly_detection_app.models import *
 from road_anomaly_detection_app.backend import *
 
-from road_anomaly_detection_app.tasks import data_classifier
+from road_anomaly_detection_app import admission
+from road_anomaly_detection_app.storage import get_store
+from road_anomaly_detection_app.jobs import enqueue, priority_for
 
-from threading import Thread
-
-import plotly.express as px
-import plotly.io as pio
 # import pandas as pd
 
 
@@ -116,14 +115,25 @@ def upload_anomaly_report_page(request):
             form = RoadAnomalyReportForm(request.POST, request.FILES, request.user)
             if form.is_valid():
                 # form.clean()
+                api = admission.wants_json(request)
+                decision = admission.admit(admission.estimate_cost(request.FILES.getlist('files')), can_reject=api)
+                if decision.action == admission.REJECT:
+                    response = JsonResponse({'error': 'Too many reports are being processed', 'retry_after': decision.retry_after}, status=429)
+                    response['Retry-After'] = str(decision.retry_after)
+                    return response
+
                 instance = form.save()
                 if instance:
-                    messages.success(request, 'Form Uploaded Successfully!')
+                    # Classified by `manage.py run_classifier_workers`
+                    delay = decision.retry_after if decision.action == admission.DEFER else 0
+                    enqueue(instance, cost=decision.cost, delay=delay, priority=priority_for(instance, request.user))
 
-                    # data_classifier(instance)
-                    thread = Thread(target=data_classifier, args=(instance, ))
-                    thread.daemon = True
-                    thread.start()
+                    if api:
+                        return JsonResponse({'report': instance.pk, 'status': decision.action, 'retry_after': delay}, status=202)
+                    if decision.action == admission.DEFER:
+                        messages.success(request, 'Form Uploaded Successfully! The server is busy, it will be processed shortly.')
+                    else:
+                        messages.success(request, 'Form Uploaded Successfully!')
 
                     # return 
                 else:
@@ -142,19 +152,30 @@ def upload_anomaly_report_page(request):
         return render(request, 'upload_form.html')
     
 
+@login_required
+def queue_depth(request):
+    """Classification backlog, for monitoring and for clients picking a retry time."""
+    return JsonResponse(admission.queue_depth())
+
+
 @login_required
 @lru_cache(maxsize=8)
 def view_reports_page(request):
     try:
-        dataset: RoadAnomalyReport = RoadAnomalyReport.objects.all()
+        # Only what the table and map show; never the images
+        dataset = list(RoadAnomalyReport.objects.only(*RoadAnomalyReport.LIST_FIELDS))
     
-        if dataset.count() == 0:
+        if not dataset:
             messages.info(request, "No reports found.")
             return render(request, 'view_reports.html', context={
                 "dataset": dataset,
                 "graph" : ""
             })
         
+        # plotly is heavy to import, only pay for it when the map is rendered
+        import plotly.express as px
+        import plotly.io as pio
+
         df_data = [{
                     "centroid_lat": i.geolocation.get('lat'),
                     "centroid_lon": i.geolocation.get('lng'),
@@ -191,11 +212,14 @@ def report_load_request(request):
 
 class AnomalyImageView(View):
     def get(self, request, report_id):
-        try:
-            report = RoadAnomalyReport.objects.only('anomalyImage').filter(pk=report_id)[0]
-        except RoadAnomalyReport.DoesNotExist:
+        report = RoadAnomalyReport.objects.only('anomaly_image_key').filter(pk=report_id).first()
+        if report is None:
             raise Http404("Report not found")
 
+        if report.anomaly_image_key:
+            return self.serve_stored(report.anomaly_image_key, report_id)
+
+        # Reports classified before the blob store
         if not report.anomalyImage:
             raise Http404("No image attached")
 
@@ -212,9 +236,32 @@ class AnomalyImageView(View):
         response['Content-Disposition'] = f'inline; filename="anomaly_{report_id}.jpg"'
         return response
 
+    def serve_stored(self, key, report_id):
+        """
+        Serve a stored image without reading it into Python: the web server
+        sends it when BLOB_STORE_SENDFILE_HEADER is set, else FileResponse
+        streams the file (through sendfile where the WSGI server supports it).
+        """
+        store = get_store()
+        filename = f"anomaly_{report_id}.jpg"
+
+        if settings.BLOB_STORE_SENDFILE_HEADER and hasattr(store, 'relative_path'):
+            response = HttpResponse(content_type='image/jpeg')
+            response[settings.BLOB_STORE_SENDFILE_HEADER] = settings.BLOB_STORE_SENDFILE_PREFIX + store.relative_path(key).as_posix()
+        elif hasattr(store, 'path'):
+            try:
+                response = FileResponse(open(store.path(key), 'rb'), content_type='image/jpeg')
+            except FileNotFoundError:
+                raise Http404("No image attached")
+        else:
+            response = HttpResponse(store.get_object(key), content_type='image/jpeg')
+
+        response['Content-Disposition'] = f'inline; filename="{filename}"'
+        return response
+
 @login_required
 def report_detailed_view_page(request, report_id):
-    data = RoadAnomalyReport.objects.filter(pk=report_id)
+    data = get_object_or_404(RoadAnomalyReport.objects.without_images(), pk=report_id)
     return render(request, 'detailed_report_view.html', context={
-        'data': data[0], 
+        'data': data, 
     })
@@ -0,0 +1,360 @@
+"""
+Benchmarks for the road anomaly detection model.
+
+Usage:
+    python -m road_anomaly_detection_model.benchmark imports
+    python -m road_anomaly_detection_model.benchmark inference --json run.json
+    python -m road_anomaly_detection_model.benchmark compare before.json after.json
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+
+# Modules a web worker / manage.py command imports on boot
+IMPORT_TARGETS = [
+    'road_anomaly_detection_model.model',
+    'road_anomaly_detection_app.tasks',
+    'road_anomaly_detection_app.views',
+]
+
+# Modules that should only be imported once inference or the map is needed
+HEAVY_MODULES = ['torch', 'ultralytics', 'plotly']
+
+
+_IMPORT_SNIPPET = '''
+import json, os, sys, time
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'road_anomaly_detection.settings')
+import django
+django.setup()
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    "seconds": elapsed,
+    "heavy_modules": [m for m in {heavy!r} if m in sys.modules],
+}}))
+'''
+
+# Synthetic frames at common phone / dashcam resolutions (width, height)
+RESOLUTIONS = [(640, 480), (1280, 720), (1920, 1080), (3840, 2160)]
+
+_FIRST_INFERENCE_SNIPPET = '''
+import json, os, time
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'road_anomaly_detection.settings')
+import django
+django.setup()
+from road_anomaly_detection_model import model
+start = time.perf_counter()
+model.get_model()
+loaded = time.perf_counter()
+model.warmup()
+warmed = time.perf_counter()
+print(json.dumps({"load_seconds": loaded - start, "warmup_seconds": warmed - loaded}))
+'''
+
+
+def _run_snippet(code, **env):
+    """Run `code` in a fresh interpreter and return its JSON output."""
+    completed = subprocess.run(
+        [sys.executable, '-c', code],
+        cwd=BASE_DIR,
+        capture_output=True,
+        text=True,
+        env={**os.environ, 'MODEL_WARMUP_ON_START': '0', **env},
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1])
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def measure_import_time(module, repeat = 3):
+    """
+    Cold-import `module` in `repeat` fresh interpreters.
+
+    Returns:
+        Dict with the best import time and the heavy modules it pulled in
+    """
+    runs = [
+        _run_snippet(_IMPORT_SNIPPET.format(module=module, heavy=HEAVY_MODULES))
+        for _ in range(repeat)
+    ]
+    return {
+        "module": module,
+        "seconds": min(run["seconds"] for run in runs),
+        "heavy_modules": runs[0]["heavy_modules"],
+    }
+
+
+def measure_first_inference(engine = None):
+    """
+    Time loading the weights and the warm-up inference in a fresh interpreter.
+    """
+    env = {'MODEL_ENGINE': engine} if engine else {}
+    return _run_snippet(_FIRST_INFERENCE_SNIPPET, **env)
+
+
+def import_benchmark(repeat = 3, include_model = False):
+    """
+    Report the cold-start cost of the modules imported at worker boot.
+    """
+    report = {"imports": [measure_import_time(module, repeat) for module in IMPORT_TARGETS]}
+
+    for entry in report["imports"]:
+        heavy = ', '.join(entry["heavy_modules"]) or 'none'
+        print(f"{entry['module']:<40} {entry['seconds'] * 1000:8.1f} ms   heavy modules: {heavy}")
+
+    if include_model:
+        try:
+            report["first_inference"] = measure_first_inference()
+            print(f"{'model load':<40} {report['first_inference']['load_seconds'] * 1000:8.1f} ms")
+            print(f"{'model warm-up':<40} {report['first_inference']['warmup_seconds'] * 1000:8.1f} ms")
+        except RuntimeError as e:
+            print(f"Model load failed: {e}")
+
+    return report
+
+
+def synthetic_road_image(width, height, seed = 0):
+    """
+    A road-like BGR frame: noisy asphalt, lane markings, a few dark cracks
+    and potholes, so decode/encode and the model see realistic content.
+    """
+    rng = np.random.default_rng(seed)
+
+    image = rng.normal(105, 18, (height, width, 1)).clip(0, 255).astype(np.uint8)
+    image = cv2.GaussianBlur(np.repeat(image, 3, axis=2), (3, 3), 0)
+
+    # Lane markings
+    for x in (width // 3, 2 * width // 3):
+        for y in range(0, height, height // 6):
+            cv2.line(image, (x, y), (x, y + height // 12), (220, 220, 220), max(2, width // 160))
+
+    # Cracks: jagged dark polylines
+    for _ in range(4):
+        points = np.cumsum(rng.integers(-width // 40, width // 40 + 1, (12, 2)), axis=0)
+        points += rng.integers(0, [width, height])
+        cv2.polylines(image, [points.astype(np.int32)], False, (40, 40, 40), max(1, width // 640))
+
+    # Potholes: dark ellipses
+    for _ in range(2):
+        center = tuple(int(v) for v in rng.integers(0, [width, height]))
+        axes = tuple(int(v) for v in rng.integers(width // 40, width // 12, 2))
+        cv2.ellipse(image, center, axes, float(rng.integers(0, 180)), 0, 360, (55, 50, 45), -1)
+
+    return image
+
+
+def load_images(resolutions = RESOLUTIONS, samples_dir = None, per_resolution = 8):
+    """
+    Encoded JPEG bytes to classify, grouped by label ('1280x720', 'samples').
+    """
+    groups = {}
+    for width, height in resolutions:
+        groups[f"{width}x{height}"] = [
+            cv2.imencode('.jpg', synthetic_road_image(width, height, seed))[1].tobytes()
+            for seed in range(per_resolution)
+        ]
+
+    if samples_dir:
+        extensions = {'.jpg', '.jpeg', '.png'}
+        paths = sorted(p for p in Path(samples_dir).iterdir() if p.suffix.lower() in extensions)
+        if paths:
+            groups['samples'] = [path.read_bytes() for path in paths]
+
+    return groups
+
+
+def percentiles(samples):
+    samples = np.asarray(samples) * 1000
+    return {
+        "p50_ms": float(np.percentile(samples, 50)),
+        "p95_ms": float(np.percentile(samples, 95)),
+        "p99_ms": float(np.percentile(samples, 99)),
+        "mean_ms": float(samples.mean()),
+    }
+
+
+def measure_latency(engine, images, batch_size, iterations, warmup_iterations = 2):
+    """
+    Time classify_batch on `engine` over `iterations` batches of `batch_size`
+    images (cache disabled, annotation on, like a real upload).
+    """
+    from road_anomaly_detection_model.model import classify_batch
+
+    batches = itertools.cycle([
+        [images[(start + i) % len(images)] for i in range(batch_size)]
+        for start in range(0, len(images), batch_size)
+    ])
+
+    latencies = []
+    for iteration in range(warmup_iterations + iterations):
+        batch = next(batches)
+        start = time.perf_counter()
+        classify_batch(batch, model=engine, batch_size=batch_size, use_cache=False)
+        if iteration >= warmup_iterations:
+            latencies.append(time.perf_counter() - start)
+
+    total = sum(latencies)
+    return {
+        "batch": percentiles(latencies),
+        "per_image": percentiles([latency / batch_size for latency in latencies]),
+        "images_per_second": batch_size * len(latencies) / total if total else 0.0,
+    }
+
+
+def inference_benchmark(engines = ('torch',), batch_sizes = (1, 4, 8), thread_counts = (None,),
+                        resolutions = RESOLUTIONS, samples_dir = None, iterations = 20, cold_start = True):
+    """
+    Latency percentiles and throughput of the classifier for every
+    combination of engine, thread count, batch size and image group.
+    """
+    from road_anomaly_detection import settings
+    from road_anomaly_detection_model.engines import load_engine
+
+    groups = load_images(resolutions, samples_dir)
+
+    report = {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "git_revision": _git_revision(),
+            "imgsz": settings.MODEL_IMGSZ,
+            "conf": settings.MODEL_CONF_THRESHOLD,
+        },
+        "cold_start": {},
+        "runs": [],
+    }
+
+    for engine_name in engines:
+        if cold_start:
+            try:
+                report["cold_start"][engine_name] = measure_first_inference(engine_name)
+            except RuntimeError as e:
+                report["cold_start"][engine_name] = {"error": str(e)}
+
+        for threads in thread_counts:
+            engine = load_engine(engine_name, threads=threads)
+
+            for batch_size, (label, images) in itertools.product(batch_sizes, groups.items()):
+                result = measure_latency(engine, images, batch_size, iterations)
+                run = {
+                    "engine": engine_name,
+                    "threads": threads,
+                    "batch_size": batch_size,
+                    "images": label,
+                    **result,
+                }
+                report["runs"].append(run)
+                print(
+                    f"{engine_name:<6} threads={threads or 'default':<8} batch={batch_size:<3} {label:<10} "
+                    f"p50={result['per_image']['p50_ms']:7.1f} ms  p95={result['per_image']['p95_ms']:7.1f} ms  "
+                    f"p99={result['per_image']['p99_ms']:7.1f} ms  {result['images_per_second']:6.1f} img/s"
+                )
+
+    return report
+
+
+def _run_key(run):
+    return (run["engine"], run["threads"], run["batch_size"], run["images"])
+
+
+def compare_reports(before, after):
+    """
+    Print the per-image p50 and throughput change of every run present
+    in both reports.
+    """
+    previous = {_run_key(run): run for run in before["runs"]}
+    for run in after["runs"]:
+        old = previous.get(_run_key(run))
+        if old is None:
+            continue
+        p50_change = run["per_image"]["p50_ms"] / old["per_image"]["p50_ms"] - 1
+        throughput_change = run["images_per_second"] / old["images_per_second"] - 1
+        engine, threads, batch_size, label = _run_key(run)
+        print(
+            f"{engine:<6} threads={threads or 'default':<8} batch={batch_size:<3} {label:<10} "
+            f"p50 {p50_change:+7.1%}  throughput {throughput_change:+7.1%}"
+        )
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, capture_output=True, text=True
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def _int_list(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    imports = subparsers.add_parser('imports', help='cold-start import times')
+    imports.add_argument('--repeat', type=int, default=3)
+    imports.add_argument('--model', action='store_true', help='also time model load and warm-up')
+    imports.add_argument('--json', dest='json_path', help='write the report to this file')
+
+    inference = subparsers.add_parser('inference', help='latency and throughput of the classifier')
+    inference.add_argument('--engines', default='torch', help='comma separated, e.g. torch,onnx')
+    inference.add_argument('--batch-sizes', type=_int_list, default=[1, 4, 8])
+    inference.add_argument('--threads', type=_int_list, default=None, help='comma separated intra-op thread counts')
+    inference.add_argument('--resolutions', default=','.join(f"{w}x{h}" for w, h in RESOLUTIONS))
+    inference.add_argument('--samples', default=None, help='directory of real sample images')
+    inference.add_argument('--iterations', type=int, default=20)
+    inference.add_argument('--no-cold-start', action='store_true')
+    inference.add_argument('--json', dest='json_path', help='write the report to this file')
+
+    compare = subparsers.add_parser('compare', help='compare two inference reports')
+    compare.add_argument('before')
+    compare.add_argument('after')
+
+    args = parser.parse_args(argv)
+    report = None
+
+    if args.command == 'imports':
+        report = import_benchmark(repeat=args.repeat, include_model=args.model)
+
+    elif args.command == 'inference':
+        os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'road_anomaly_detection.settings')
+        report = inference_benchmark(
+            engines=[engine for engine in args.engines.split(',') if engine],
+            batch_sizes=args.batch_sizes,
+            thread_counts=args.threads or [None],
+            resolutions=[tuple(int(v) for v in r.split('x')) for r in args.resolutions.split(',') if r],
+            samples_dir=args.samples,
+            iterations=args.iterations,
+            cold_start=not args.no_cold_start,
+        )
+
+    elif args.command == 'compare':
+        with open(args.before) as before, open(args.after) as after:
+            compare_reports(json.load(before), json.load(after))
+        return
+
+    if report is not None and args.json_path:
+        with open(args.json_path, 'w') as file:
+            json.dump(report, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+"""
+Content-hash cache of classification results.
+
+Entries are keyed on the SHA-256 of the media bytes, the model version
+(engine + weights hash) and the confidence threshold, and hold the detection
+JSON plus the annotated image. The store is a local SQLite file, evicted
+least-recently-used once it grows past settings.MODEL_CACHE_MAX_BYTES.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+from road_anomaly_detection import settings
+
+
+class ResultCache:
+    def __init__(self, path, max_bytes):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                image BLOB,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access)")
+        self._connection.commit()
+
+    @staticmethod
+    def make_key(data, model_version, conf):
+        """
+        Cache key for `data` classified by `model_version` at threshold `conf`.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        return f"{digest}:{model_version}:{conf}"
+
+    def get(self, key):
+        """
+        Returns:
+            Tuple of (classifier output structure, annotated image bytes),
+            or None on a miss
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT result, image FROM results WHERE key = ?", (key,)
+            ).fetchone()
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            self._connection.execute(
+                "UPDATE results SET last_access = ? WHERE key = ?", (time.time(), key)
+            )
+            self._connection.commit()
+
+        return json.loads(row[0]), row[1]
+
+    def put(self, key, result, image):
+        payload = json.dumps(result)
+        size = len(payload) + (len(image) if image else 0)
+
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO results (key, result, image, size, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, payload, image, size, time.time())
+            )
+            self._evict()
+            self._connection.commit()
+
+    def _evict(self):
+        total = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        # Drop least recently used entries until we are back under the limit
+        stale = []
+        for key, size in self._connection.execute("SELECT key, size FROM results ORDER BY last_access"):
+            if total <= self.max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+
+        self._connection.executemany("DELETE FROM results WHERE key = ?", stale)
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM results")
+            self._connection.commit()
+
+    def stats(self):
+        """
+        Hit/miss counters of this process plus the current store size.
+        """
+        with self._lock:
+            entries, size = self._connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results"
+            ).fetchone()
+
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": size,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """
+    Return the process-wide result cache, or None when caching is disabled.
+    """
+    global _cache
+    if not settings.MODEL_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResultCache(settings.MODEL_CACHE_PATH, settings.MODEL_CACHE_MAX_BYTES)
+    return _cache
@@ -0,0 +1,282 @@
+"""
+Inference engines behind the classifier.
+
+Every engine takes decoded BGR images and returns, per image, an (N, 6)
+float32 array of detections in original image coordinates:
+
+    x1, y1, x2, y2, confidence, class_id
+
+Usage (export the ONNX weights used by the onnx engine):
+    python -m road_anomaly_detection_model.engines export
+"""
+import argparse
+import shutil
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from road_anomaly_detection import settings
+from road_anomaly_detection_model.timing import record
+
+
+# Same defaults as ultralytics predict, so both engines agree
+IOU_THRESHOLD = 0.7
+MAX_DETECTIONS = 300
+
+# Offset added per class so one NMS pass never merges boxes of different classes
+_CLASS_OFFSET = 7680
+
+
+class InferenceEngine:
+    """
+    Base class for inference backends.
+    """
+    name = None
+
+    def predict(self, images, conf = 0.3, imgsz = 640):
+        """
+        Args:
+            images: list of decoded BGR ndarrays
+            conf: Minimum confidence of a detection
+            imgsz: Network input size
+
+        Returns:
+            List of (N, 6) float32 arrays, one per image
+        """
+        raise NotImplementedError
+
+    def warmup(self, imgsz = 640):
+        self.predict([np.zeros((imgsz, imgsz, 3), dtype=np.uint8)], imgsz=imgsz)
+
+
+class TorchEngine(InferenceEngine):
+    """
+    ultralytics YOLO running on PyTorch.
+    """
+    name = 'torch'
+
+    def __init__(self, weights, threads = None):
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+
+        from ultralytics import YOLO
+
+        self.weights = Path(weights)
+        self.model = YOLO(str(weights))
+
+    def predict(self, images, conf = 0.3, imgsz = 640):
+        results = self.model(images, imgsz=imgsz, conf=conf, iou=IOU_THRESHOLD, max_det=MAX_DETECTIONS, verbose=False)
+
+        # ultralytics measures its own stages (ms per image)
+        if results:
+            for stage, milliseconds in results[0].speed.items():
+                record(f"yolo_{stage}", milliseconds * len(results) / 1000, images=len(results))
+
+        return [result.boxes.data.cpu().numpy().astype(np.float32) for result in results]
+
+
+class OnnxEngine(InferenceEngine):
+    """
+    YOLO exported to ONNX running on ONNX Runtime (CPU), with letterbox
+    preprocessing and NMS done here in numpy.
+    """
+    name = 'onnx'
+
+    def __init__(self, weights, threads = None):
+        import onnxruntime as ort
+
+        weights = Path(weights)
+        if not weights.exists():
+            raise FileNotFoundError(
+                f"ONNX weights not found: {weights}. "
+                "Export them with `python -m road_anomaly_detection_model.engines export`."
+            )
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+
+        self.weights = weights
+        self.session = ort.InferenceSession(str(weights), options, providers=['CPUExecutionProvider'])
+
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        # Fixed input size if exported without dynamic axes
+        self.input_size = model_input.shape[2] if isinstance(model_input.shape[2], int) else None
+        self.dynamic_batch = not isinstance(model_input.shape[0], int)
+
+    def predict(self, images, conf = 0.3, imgsz = 640):
+        if not images:
+            return []
+
+        size = self.input_size or imgsz
+        letterboxed = [letterbox(image, size) for image in images]
+
+        # BGR HWC uint8 -> RGB NCHW float32 in [0, 1]
+        batch = np.stack([padded for padded, _, _ in letterboxed])
+        batch = np.ascontiguousarray(batch[..., ::-1].transpose(0, 3, 1, 2), dtype=np.float32) / 255.0
+
+        if self.dynamic_batch:
+            outputs = self.session.run(None, {self.input_name: batch})[0]
+        else:
+            outputs = np.concatenate([
+                self.session.run(None, {self.input_name: batch[i:i + 1]})[0]
+                for i in range(len(batch))
+            ])
+
+        return [
+            postprocess(output, conf, ratio, pad, image.shape[:2])
+            for output, image, (_, ratio, pad) in zip(outputs, images, letterboxed)
+        ]
+
+
+def letterbox(image, size, color = (114, 114, 114)):
+    """
+    Resize keeping the aspect ratio and pad to a `size` x `size` square.
+
+    Returns:
+        Tuple of (padded image, scale ratio, (pad_x, pad_y))
+    """
+    height, width = image.shape[:2]
+    ratio = min(size / height, size / width)
+    new_width, new_height = int(round(width * ratio)), int(round(height * ratio))
+
+    if (new_width, new_height) != (width, height):
+        image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+
+    pad_x, pad_y = (size - new_width) / 2, (size - new_height) / 2
+    top, bottom = int(round(pad_y - 0.1)), int(round(pad_y + 0.1))
+    left, right = int(round(pad_x - 0.1)), int(round(pad_x + 0.1))
+    image = cv2.copyMakeBorder(image, top, bottom, left, right, cv2.BORDER_CONSTANT, value=color)
+
+    return image, ratio, (left, top)
+
+
+def nms(boxes, scores, iou_threshold = IOU_THRESHOLD):
+    """
+    Greedy non-maximum suppression, IoU computed against all remaining
+    boxes at once.
+
+    Args:
+        boxes: (N, 4) array of x1, y1, x2, y2
+        scores: (N,) array of confidences
+
+    Returns:
+        Indices of the kept boxes, highest score first
+    """
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (x2 - x1) * (y2 - y1)
+    order = scores.argsort()[::-1]
+
+    keep = []
+    while order.size > 0:
+        best, rest = order[0], order[1:]
+        keep.append(best)
+
+        width = np.clip(np.minimum(x2[best], x2[rest]) - np.maximum(x1[best], x1[rest]), 0, None)
+        height = np.clip(np.minimum(y2[best], y2[rest]) - np.maximum(y1[best], y1[rest]), 0, None)
+        intersection = width * height
+        iou = intersection / (areas[best] + areas[rest] - intersection + 1e-9)
+
+        order = rest[iou <= iou_threshold]
+
+    return np.asarray(keep, dtype=np.intp)
+
+
+def batched_nms(boxes, scores, class_ids, iou_threshold = IOU_THRESHOLD):
+    """
+    Per-class NMS in a single pass by shifting each class to its own
+    coordinate range.
+    """
+    offsets = class_ids[:, None].astype(boxes.dtype) * _CLASS_OFFSET
+    return nms(boxes + offsets, scores, iou_threshold)
+
+
+def postprocess(output, conf, ratio, pad, shape, iou_threshold = IOU_THRESHOLD, max_det = MAX_DETECTIONS):
+    """
+    Turn one raw YOLOv8 output of shape (4 + classes, anchors) into
+    an (N, 6) detection array in original image coordinates.
+    """
+    predictions = output.T
+    class_scores = predictions[:, 4:]
+    class_ids = class_scores.argmax(axis=1)
+    confidences = class_scores[np.arange(len(class_scores)), class_ids]
+
+    mask = confidences > conf
+    if not mask.any():
+        return np.zeros((0, 6), dtype=np.float32)
+
+    xywh = predictions[mask, :4]
+    confidences = confidences[mask]
+    class_ids = class_ids[mask]
+
+    # Center/size -> corners
+    boxes = np.empty_like(xywh)
+    boxes[:, :2] = xywh[:, :2] - xywh[:, 2:] / 2
+    boxes[:, 2:] = xywh[:, :2] + xywh[:, 2:] / 2
+
+    keep = batched_nms(boxes, confidences, class_ids, iou_threshold)[:max_det]
+    boxes, confidences, class_ids = boxes[keep], confidences[keep], class_ids[keep]
+
+    # Undo the letterbox
+    boxes[:, [0, 2]] = (boxes[:, [0, 2]] - pad[0]) / ratio
+    boxes[:, [1, 3]] = (boxes[:, [1, 3]] - pad[1]) / ratio
+    boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, shape[1])
+    boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, shape[0])
+
+    return np.column_stack([boxes, confidences, class_ids]).astype(np.float32)
+
+
+ENGINES = {
+    TorchEngine.name: TorchEngine,
+    OnnxEngine.name: OnnxEngine,
+}
+
+
+def load_engine(name = None, threads = None):
+    """
+    Build the inference engine configured by settings.MODEL_ENGINE.
+
+    Args:
+        name: Engine name (default: settings.MODEL_ENGINE)
+        threads: Intra-op threads of the engine (default: backend default)
+    """
+    name = name or settings.MODEL_ENGINE
+    if name == TorchEngine.name:
+        return TorchEngine(settings.MODEL_WEIGHTS, threads=threads)
+    if name == OnnxEngine.name:
+        return OnnxEngine(settings.MODEL_ONNX_WEIGHTS, threads=threads)
+    raise ValueError(f"Unknown inference engine: {name!r} (expected one of {', '.join(ENGINES)})")
+
+
+def export_onnx(weights = None, output = None, imgsz = None):
+    """
+    Export the PyTorch weights to ONNX with a dynamic batch axis.
+    """
+    from ultralytics import YOLO
+
+    weights = Path(weights or settings.MODEL_WEIGHTS)
+    output = Path(output or settings.MODEL_ONNX_WEIGHTS)
+    imgsz = imgsz or settings.MODEL_IMGSZ
+
+    exported = YOLO(str(weights)).export(format='onnx', imgsz=imgsz, dynamic=True, simplify=True)
+    if Path(exported).resolve() != output.resolve():
+        shutil.move(exported, output)
+    return output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Inference engine utilities')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    export = subparsers.add_parser('export', help='export the PyTorch weights to ONNX')
+    export.add_argument('--weights', default=None)
+    export.add_argument('--output', default=None)
+    export.add_argument('--imgsz', type=int, default=None)
+
+    args = parser.parse_args()
+    if args.command == 'export':
+        print(f"✓ Exported: {export_onnx(args.weights, args.output, args.imgsz)}")
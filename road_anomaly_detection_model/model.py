@@ -1,153 +1,465 @@
 import os
 os.environ['TORCH_DEVICE_BACKEND_AUTOLOAD'] = '0'
 
+import hashlib
+import logging
+import threading
+
 import cv2
 import numpy as np
 # import matplotlib.pyplot as plt
 # from matplotlib.patches import Rectangle
-from ultralytics import YOLO
 from pathlib import Path
 
 from road_anomaly_detection import settings
+from road_anomaly_detection_model.cache import get_cache
+from road_anomaly_detection_model.engines import load_engine
+from road_anomaly_detection_model.tiling import predict_tiled
+from road_anomaly_detection_model.timing import timed
+
+
+logger = logging.getLogger(__name__)
+
+
+
+# Process-wide inference engine, created on first use so importing this
+# module (and everything that imports it) does not pay for torch/ultralytics
+_model = None
+_model_lock = threading.Lock()
+
+
+def get_model(threads = None):
+    """
+    Return the process-wide inference engine (settings.MODEL_ENGINE),
+    loading the weights on first use.
+
+    Args:
+        threads: Intra-op threads, only used when the engine is created
+    """
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                _model = load_engine(threads=threads)  # load a custom model
+    return _model
+
+
+def warmup(imgsz = None):
+    """
+    Load the model and run one dummy inference at the configured image size,
+    so the first real request does not pay for lazy initialisation.
+    """
+    imgsz = imgsz or settings.MODEL_IMGSZ
+    model = get_model()
+    model.warmup(imgsz)
+    return model
+
+
+_versions = {}
 
 
+def model_version():
+    """
+    Identify the configured engine and weights, e.g. 'torch-1a2b3c4d5e6f7a8b'.
+    The weights are hashed once per file change.
+    """
+    weights = Path(settings.MODEL_ONNX_WEIGHTS if settings.MODEL_ENGINE == 'onnx' else settings.MODEL_WEIGHTS)
+    stat = weights.stat()
+    key = (settings.MODEL_ENGINE, str(weights), stat.st_mtime_ns, stat.st_size)
+
+    if key not in _versions:
+        digest = hashlib.sha256()
+        with open(weights, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                digest.update(block)
+        _versions[key] = f"{settings.MODEL_ENGINE}-{digest.hexdigest()[:16]}"
+
+    return _versions[key]
+
+
+def __getattr__(name):
+    # Keep `from road_anomaly_detection_model.model import model` working lazily
+    if name == 'model':
+        return get_model()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+CLASS_NAMES = {
+    0: 'D00_Longitudinal_Crack',
+    1: 'D10_Transverse_Crack',
+    2: 'D20_Alligator_Crack',
+    3: 'D40_Pothole'
+}
+
+# Colors for each class (BGR format for OpenCV)
+CLASS_COLORS = {
+    0: (0, 255, 0),      # D00 - Green
+    1: (255, 0, 0),      # D10 - Blue
+    2: (0, 165, 255),    # D20 - Orange
+    3: (255, 0, 255)     # D40 - Magenta
+}
 
-model = YOLO('road_anomaly_detection_model/models/best.pt')  # load a custom model
 
+def decode_image(data):
+    """
+    Decode raw image bytes (e.g. a MediaContent blob) into a BGR ndarray.
+
+    Args:
+        data: bytes/bytearray/memoryview of an encoded image, or an already
+              decoded ndarray (returned unchanged)
+
+    Returns:
+        BGR ndarray, or None if the bytes cannot be decoded
+    """
+    if isinstance(data, np.ndarray):
+        return data
 
-def draw_boxes_on_image(image_path, predictions, output_path, class_names):
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    if buffer.size == 0:
+        return None
+    return cv2.imdecode(buffer, cv2.IMREAD_COLOR)
+
+
+def encode_image(image, ext='.jpg'):
+    """
+    Encode a BGR ndarray to image bytes without touching the disk.
+    """
+    ok, buffer = cv2.imencode(ext, image)
+    if not ok:
+        raise ValueError(f"Cannot encode image as {ext}")
+    return buffer.tobytes()
+
+
+# One row per detection, every field converted once for the whole array
+DETECTION_DTYPE = np.dtype([
+    ('class_id', np.int32),
+    ('confidence', np.float64),
+    ('x1', np.int32),
+    ('y1', np.int32),
+    ('x2', np.int32),
+    ('y2', np.int32),
+    ('area', np.int64),
+])
+
+
+def to_records(detections):
+    """
+    Convert the (N, 6) detection array from the inference engine into a
+    DETECTION_DTYPE structured array, computing box areas in one pass.
+    """
+    # The engine's float32 values, widened like the Python floats of the
+    # per-box conversion so areas of large boxes come out the same
+    detections = np.asarray(detections, dtype=np.float32).reshape(-1, 6).astype(np.float64)
+
+    records = np.empty(len(detections), dtype=DETECTION_DTYPE)
+    records['class_id'] = detections[:, 5]
+    records['confidence'] = np.round(detections[:, 4], 4)
+    # int() truncation, like the per-box conversion it replaces
+    for column, field in enumerate(('x1', 'y1', 'x2', 'y2')):
+        records[field] = detections[:, column]
+    records['area'] = (detections[:, 2] - detections[:, 0]) * (detections[:, 3] - detections[:, 1])
+
+    return records
+
+
+def records_from_result(result, class_names = CLASS_NAMES):
+    """
+    Rebuild DETECTION_DTYPE records from a classifier output structure,
+    e.g. to annotate a frame that was classified without annotation.
+    """
+    detections = result.get('detections') or []
+    class_ids = {name: class_id for class_id, name in class_names.items()}
+
+    records = np.empty(len(detections), dtype=DETECTION_DTYPE)
+    for record, detection in zip(records, detections):
+        box = detection['bounding_box']
+        record['class_id'] = class_ids.get(detection['class'], -1)
+        record['confidence'] = detection['confidence']
+        record['x1'], record['y1'], record['x2'], record['y2'] = box['x1'], box['y1'], box['x2'], box['y2']
+        record['area'] = detection['area_pixels']
+
+    return records
+
+
+def annotate_image(image, predictions, class_names):
+    """
+    Draw bounding boxes with detection results onto `image` in place.
+
+    Args:
+        image: BGR ndarray to draw on
+        predictions: (N, 6) detection array from the inference engine
+                     or DETECTION_DTYPE records
+        class_names: Dictionary of class IDs to class names
+
+    Returns:
+        The annotated image
+    """
+    records = predictions if predictions.dtype == DETECTION_DTYPE else to_records(predictions)
+
+    # Process predictions
+    for class_id, confidence, x1, y1, x2, y2, _ in records.tolist():
+        class_name = class_names.get(class_id, f"Class_{class_id}")
+        
+        # Get color for this class
+        color = CLASS_COLORS.get(class_id, (255, 255, 255))
+        
+        # Draw rectangle
+        cv2.rectangle(image, (x1, y1), (x2, y2), color, 2)
+        
+        # Prepare label text
+        label = f"{class_name} ({confidence:.2f})"
+        
+        # Draw label background
+        label_size = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 2)[0]
+        label_y = max(20, y1 - 10)
+        cv2.rectangle(image, (x1, label_y - label_size[1] - 5), 
+                    (x1 + label_size[0], label_y + 5), color, -1)
+        
+        # Draw label text
+        cv2.putText(image, label, (x1, label_y), 
+                  cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
+
+    return image
+
+
+def draw_boxes_on_image(image_path, predictions, output_path, class_names, image = None):
     """
     Draw bounding boxes on image with detection results
     
     Args:
         image_path: Path to input image
-        predictions: YOLO predictions
+        predictions: (N, 6) detection array from the inference engine
         output_path: Path to save annotated image
         class_names: Dictionary of class IDs to class names
+        image: The already decoded image, to avoid reading `image_path` again
     """
     # Read image
-    image = cv2.imread(image_path)
     if image is None:
-        print(f"Error reading image: {image_path}")
+        image = cv2.imread(image_path)
+    if image is None:
+        logger.error("Error reading image: %s", image_path)
         return None
-    
-    img_height, img_width = image.shape[:2]
-    
-    # Colors for each class (BGR format for OpenCV)
-    colors = {
-        0: (0, 255, 0),      # D00 - Green
-        1: (255, 0, 0),      # D10 - Blue
-        2: (0, 165, 255),    # D20 - Orange
-        3: (255, 0, 255)     # D40 - Magenta
-    }
-    
-    # Process predictions
-    for result in predictions:
-        if len(result.boxes) > 0:
-            for box in result.boxes:
-                # Get bounding box coordinates
-                x1, y1, x2, y2 = map(int, box.xyxy[0])
-                
-                # Get class and confidence
-                class_id = int(box.cls[0])
-                confidence = float(box.conf[0])
-                class_name = class_names.get(class_id, f"Class_{class_id}")
-                
-                # Get color for this class
-                color = colors.get(class_id, (255, 255, 255))
-                
-                # Draw rectangle
-                cv2.rectangle(image, (x1, y1), (x2, y2), color, 2)
-                
-                # Prepare label text
-                label = f"{class_name} ({confidence:.2f})"
-                
-                # Draw label background
-                label_size = cv2.getTextSize(label, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 2)[0]
-                label_y = max(20, y1 - 10)
-                cv2.rectangle(image, (x1, label_y - label_size[1] - 5), 
-                            (x1 + label_size[0], label_y + 5), color, -1)
-                
-                # Draw label text
-                cv2.putText(image, label, (x1, label_y), 
-                          cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
+
+    with timed('annotate'):
+        annotate_image(image, predictions, class_names)
     
     # Save annotated image
-    cv2.imwrite(output_path, image)
-    print(f"✓ Annotated image saved: {output_path}")
+    with timed('imwrite'):
+        cv2.imwrite(output_path, image)
+    logger.debug("Annotated image saved: %s", output_path)
     
     return image
 
 
-
-
-def detect_and_annotate_image(image_path, model, class_names, output_dir):
+def build_detections(detections, image_name, class_names):
     """
-    Detect damages in image, draw boxes, and save results
+    Convert the (N, 6) detection array (or DETECTION_DTYPE records) for one
+    image into the classifier output structure.
     """
-
     json_structure = {
-        "image_name": Path(image_path).name,
+        "image_name": image_name,
         "detections": []
     }
 
-    print(f"\n{'='*70}")
-    print(f"Processing: {Path(image_path).name}")
-    print(f"{'='*70}")
-    
-    # Run inference
-    results = model(image_path, conf=0.3, verbose=False)
-    
+    records = detections if detections.dtype == DETECTION_DTYPE else to_records(detections)
+
     # Print detection info
-    if len(results) > 0 and len(results[0].boxes) > 0:
-        print(f"\n✓ Detections found: {len(results[0].boxes)}")
-        
-        for idx, box in enumerate(results[0].boxes):
-            class_id = int(box.cls[0])
-            confidence = float(box.conf[0])
-            x1, y1, x2, y2 = map(float, box.xyxy[0])
-            area = (x2 - x1) * (y2 - y1)
-            
-            class_name = class_names.get(class_id, f"Class_{class_id}")
-
-            json_structure["detections"].append({
-                "class": class_name,
-                "confidence": round(confidence, 4),
+    if len(records) > 0:
+        logger.debug("%s: %d detections found", image_name, len(records))
+
+        json_structure["detections"] = [
+            {
+                "class": class_names.get(class_id, f"Class_{class_id}"),
+                "confidence": confidence,
                 "bounding_box": {
-                    "x1": int(x1),
-                    "y1": int(y1),
-                    "x2": int(x2),
-                    "y2": int(y2)
+                    "x1": x1,
+                    "y1": y1,
+                    "x2": x2,
+                    "y2": y2
                 },
-                "area_pixels": int(area)
-            })
+                "area_pixels": area
+            }
+            for class_id, confidence, x1, y1, x2, y2, area in records.tolist()
+        ]
 
-        best = max(json_structure["detections"], key=lambda x: x['confidence'])            
+        # First of the highest confidences, as max() over the list would pick
+        best = json_structure["detections"][int(records['confidence'].argmax())]
         json_structure['main_class'] = best['class']
         json_structure['main_confidence'] = best['confidence']
 
     else:
         json_structure["detections"] = None
-        print("✗ No detections found")
+        logger.debug("%s: no detections found", image_name)
+
+    return json_structure
+
+
+def detect_and_annotate_image(image_path, model, class_names, output_dir):
+    """
+    Detect damages in image, draw boxes, and save results
+    """
+    logger.debug("Processing: %s", Path(image_path).name)
     
-    # Draw boxes on image
+    # Run inference
+    if model is None:
+        model = get_model()
+    with timed('imread'):
+        image = cv2.imread(image_path)
+    if image is None:
+        logger.error("Error reading image: %s", image_path)
+        return None
+    with timed('inference', images=1):
+        detections = model.predict([image], conf=settings.MODEL_CONF_THRESHOLD, imgsz=settings.MODEL_IMGSZ)[0]
+
+    with timed('postprocess'):
+        detections = to_records(detections)
+        json_structure = build_detections(detections, Path(image_path).name, class_names)
+    
+    # Draw boxes on the frame decoded for inference instead of reading it again
     # annotated_path = os.path.join(output_dir, f"annotated_{Path(image_path).stem}.jpg")
-    draw_boxes_on_image(image_path, results, image_path, class_names)
+    draw_boxes_on_image(image_path, detections, image_path, class_names, image=image)
         
     return json_structure
 
-def classifier(input_image_path, model = model, ):
+
+def _predict(model, images, conf, tiled):
+    """
+    Run the engine on decoded images; with `tiled`, images whose longer side
+    exceeds settings.MODEL_TILE_MIN_SIDE are cut into native-resolution tiles.
+    """
+    results = [None] * len(images)
+
+    regular = []
+    for i, image in enumerate(images):
+        if tiled and max(image.shape[:2]) > settings.MODEL_TILE_MIN_SIDE:
+            results[i] = predict_tiled(
+                model, image, conf,
+                tile_size=settings.MODEL_TILE_SIZE,
+                overlap=settings.MODEL_TILE_OVERLAP,
+                max_tiles=settings.MODEL_MAX_TILES_IN_MEMORY,
+                full_image_size=settings.MODEL_IMGSZ,
+            )
+        else:
+            regular.append(i)
+
+    if regular:
+        for i, detections in zip(regular, model.predict([images[i] for i in regular], conf=conf, imgsz=settings.MODEL_IMGSZ)):
+            results[i] = detections
+
+    return results
+
+
+def classify_batch(images, model = None, batch_size = None, image_names = None, annotate = True, class_names = CLASS_NAMES, use_cache = True, tiled = None):
+    """
+    Detect damages in several in-memory images, running them through the
+    inference engine `batch_size` images per forward pass.
+
+    Args:
+        images: list of encoded image bytes and/or decoded BGR ndarrays
+        model: Inference engine (default: the shared engine)
+        batch_size: Images per forward pass (default: settings.MODEL_BATCH_SIZE)
+        image_names: Names reported in the output structures, one per image
+        annotate: Whether to draw and encode the annotated images
+        class_names: Dictionary of class IDs to class names
+        use_cache: Look encoded images up in the result cache first
+        tiled: Detect on overlapping native-resolution tiles of large images
+               (default: settings.MODEL_TILED)
+
+    Returns:
+        List of (classifier output structure, annotated JPEG bytes) tuples in
+        the order of `images`; (None, None) for images that cannot be decoded
+        and annotated bytes of None when `annotate` is False
+    """
+    if model is None:
+        model = get_model()
+    batch_size = max(1, batch_size or settings.MODEL_BATCH_SIZE)
+    if image_names is None:
+        image_names = [None] * len(images)
+
+    conf = settings.MODEL_CONF_THRESHOLD
+    tiled = settings.MODEL_TILED if tiled is None else tiled
+    cache = get_cache() if use_cache else None
+    version = model_version() if cache is not None else None
+    if version is not None and tiled:
+        version = f"{version}-tiled{settings.MODEL_TILE_SIZE}"
+
+    outputs = [(None, None)] * len(images)
+
+    for start in range(0, len(images), batch_size):
+        # Decode per chunk so at most one batch of frames is held in memory
+        chunk = []
+        for index in range(start, min(start + batch_size, len(images))):
+            data = images[index]
+
+            # Duplicate uploads cost one hash and one lookup
+            key = None
+            if cache is not None and isinstance(data, (bytes, bytearray, memoryview)):
+                with timed('cache_lookup'):
+                    key = cache.make_key(data, version, conf)
+                    cached = cache.get(key)
+                if cached is not None and (cached[1] is not None or not annotate):
+                    json_structure, annotated = cached
+                    json_structure['image_name'] = image_names[index]
+                    outputs[index] = (json_structure, annotated if annotate else None)
+                    continue
+
+            with timed('decode'):
+                image = decode_image(data)
+            if image is not None:
+                chunk.append((index, image, key))
+
+        if not chunk:
+            continue
+
+        with timed('inference', images=len(chunk)):
+            results = _predict(model, [image for _, image, _ in chunk], conf, tiled)
+
+        for (index, image, key), detections in zip(chunk, results):
+            with timed('postprocess'):
+                detections = to_records(detections)
+                json_structure = build_detections(detections, image_names[index], class_names)
+
+            annotated = None
+            if annotate:
+                # Draw on a copy so callers passing an ndarray keep their frame untouched
+                with timed('annotate'):
+                    annotated = annotate_image(image.copy(), detections, class_names)
+                with timed('encode'):
+                    annotated = encode_image(annotated)
+
+                if key is not None:
+                    with timed('cache_store'):
+                        cache.put(key, json_structure, annotated)
+
+            outputs[index] = (json_structure, annotated)
+
+    return outputs
+
+
+def classify_image(image, model = None, image_name = None, class_names = CLASS_NAMES):
+    """
+    Detect damages in an in-memory image and annotate it, without any
+    temp-file round trip.
+
+    Args:
+        image: encoded image bytes (e.g. MediaContent.binary_data) or a
+               decoded BGR ndarray (e.g. a video frame)
+        model: Inference engine (default: the shared engine)
+        image_name: Name reported in the output structure
+        class_names: Dictionary of class IDs to class names
+
+    Returns:
+        Tuple of (classifier output structure, annotated JPEG bytes),
+        or (None, None) if the image cannot be decoded
+    """
+    return classify_batch([image], model=model, image_names=[image_name], class_names=class_names)[0]
+
+
+def classifier(input_image_path, model = None, ):
     if not os.path.exists(input_image_path):
         return None
-    
-    class_names = {
-        0: 'D00_Longitudinal_Crack',
-        1: 'D10_Transverse_Crack',
-        2: 'D20_Alligator_Crack',
-        3: 'D40_Pothole'
-    }
 
-    return detect_and_annotate_image(input_image_path, model, class_names, input_image_path)
+    return detect_and_annotate_image(input_image_path, model, CLASS_NAMES, input_image_path)
 
 
 
@@ -155,13 +467,6 @@ def classifier(input_image_path, model = model, ):
 
 if __name__ == "__main__":
     
-    class_names = {
-        0: 'D00_Longitudinal_Crack',
-        1: 'D10_Transverse_Crack',
-        2: 'D20_Alligator_Crack',
-        3: 'D40_Pothole'
-    }
-    
     # Input image path
     input_image_path = 'data/1.jpg'  # Replace with your image path
     
@@ -170,4 +475,4 @@ if __name__ == "__main__":
     os.makedirs(output_directory, exist_ok=True)
     
     # Run detection and annotation
-    print(detect_and_annotate_image(input_image_path, model, class_names, output_directory))
+    print(detect_and_annotate_image(input_image_path, get_model(), CLASS_NAMES, output_directory))
@@ -0,0 +1,116 @@
+"""
+Process pool of model replicas.
+
+Each worker process loads the weights once, limits its engine to
+`threads` intra-op threads so replicas x threads matches the core count,
+and can pin itself to its own CPU set. Inference then scales with cores
+instead of contending on one model behind the GIL.
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from road_anomaly_detection import settings
+
+
+def available_cpus():
+    """CPUs this process may run on, sorted."""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def plan_replicas(processes, threads = None, pin = False):
+    """
+    Split the available CPUs between `processes` replicas.
+
+    Returns:
+        Tuple of (threads per replica, list of CPU sets or None per replica)
+    """
+    cpus = available_cpus()
+    processes = max(1, processes)
+    threads = threads or max(1, len(cpus) // processes)
+
+    if not pin:
+        return threads, [None] * processes
+
+    # Contiguous chunks keep each replica's threads on neighbouring cores
+    cpu_sets = [
+        set(cpus[(i * threads) % len(cpus):(i * threads) % len(cpus) + threads]) or set(cpus)
+        for i in range(processes)
+    ]
+    return threads, cpu_sets
+
+
+def _init_worker(slot_counter, threads, cpu_sets):
+    with slot_counter.get_lock():
+        slot = slot_counter.value
+        slot_counter.value += 1
+
+    cpu_set = cpu_sets[slot % len(cpu_sets)]
+    if cpu_set and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpu_set)
+
+    # OpenMP/BLAS pools read these when the engine is imported
+    for variable in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS'):
+        os.environ[variable] = str(threads)
+
+    from road_anomaly_detection_model import model
+
+    # Load the weights once per replica, before the first job arrives
+    model.get_model(threads=threads)
+    model.warmup()
+
+
+def _classify(images, image_names, annotate, batch_size):
+    from road_anomaly_detection_model.model import classify_batch
+
+    return classify_batch(images, image_names=image_names, annotate=annotate, batch_size=batch_size)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Return the process-wide pool of settings.INFERENCE_PROCESSES replicas.
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                threads, cpu_sets = plan_replicas(
+                    settings.INFERENCE_PROCESSES,
+                    settings.INFERENCE_THREADS_PER_PROCESS,
+                    settings.INFERENCE_PIN_CPUS,
+                )
+                # spawn: forking a process that already runs threads is unsafe
+                context = multiprocessing.get_context('spawn')
+                _pool = ProcessPoolExecutor(
+                    max_workers=settings.INFERENCE_PROCESSES,
+                    mp_context=context,
+                    initializer=_init_worker,
+                    initargs=(context.Value('i', 0), threads, cpu_sets),
+                )
+    return _pool
+
+
+def classify_in_pool(images, image_names = None, annotate = True, batch_size = None):
+    """
+    classify_batch on one of the replicas; blocks until it is done.
+    """
+    global _pool
+    pool = get_pool()
+    # Blobs may be memoryviews over an mmap, which cannot be pickled
+    images = [bytes(image) if isinstance(image, memoryview) else image for image in images]
+    try:
+        return pool.submit(_classify, images, image_names, annotate, batch_size).result()
+    except BrokenProcessPool:
+        # A replica died (e.g. OOM); start a fresh pool for the next job
+        with _pool_lock:
+            if _pool is pool:
+                _pool = None
+        raise
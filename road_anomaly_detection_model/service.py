@@ -0,0 +1,153 @@
+"""
+In-process micro-batching inference service.
+
+Classification jobs run in many threads. Instead of each thread calling the
+engine on its own, they submit images to one service thread that collects
+pending requests up to `max_batch_size` images or `max_wait` seconds and
+runs them through the model together. Results come back through futures.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from road_anomaly_detection import settings
+from road_anomaly_detection_model.model import classify_batch
+
+
+class _Request:
+    __slots__ = ('image', 'image_name', 'annotate', 'future')
+
+    def __init__(self, image, image_name, annotate):
+        self.image = image
+        self.image_name = image_name
+        self.annotate = annotate
+        self.future = Future()
+
+
+class InferenceService:
+    def __init__(self, max_batch_size, max_wait, runner = classify_batch, concurrency = 1):
+        """
+        Args:
+            max_batch_size: Most images run through the model together
+            max_wait: Seconds the first pending image waits for others to join
+            runner: Callable with the classify_batch signature doing the work
+            concurrency: Batches handed to `runner` at the same time
+                         (one per model replica)
+        """
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+        self.runner = runner
+        self.concurrency = max(1, concurrency)
+        self._executor = None
+        if self.concurrency > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='inference-dispatch')
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self._loop, name='inference-service', daemon=True)
+                    self._thread.start()
+
+    def submit(self, image, image_name = None, annotate = True):
+        """
+        Queue one image (encoded bytes or decoded ndarray) for classification.
+
+        Returns:
+            Future resolving to the (classifier output, annotated bytes) tuple
+            classify_batch returns for it
+        """
+        request = _Request(image, image_name, annotate)
+        self._ensure_started()
+        self._queue.put(request)
+        return request.future
+
+    def classify(self, images, image_names = None, annotate = True):
+        """
+        Submit several images and wait for all of them, like classify_batch.
+        """
+        if image_names is None:
+            image_names = [None] * len(images)
+
+        futures = [self.submit(image, name, annotate) for image, name in zip(images, image_names)]
+        return [future.result() for future in futures]
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = [request for request in self._collect() if request.future.set_running_or_notify_cancel()]
+
+            # Requests differ only in whether they want the annotated image
+            for annotate in (True, False):
+                group = [request for request in batch if request.annotate == annotate]
+                if group:
+                    if self._executor is None:
+                        self._run(group, annotate)
+                    else:
+                        self._executor.submit(self._run, group, annotate)
+
+    def _run(self, group, annotate):
+        try:
+            outputs = self.runner(
+                [request.image for request in group],
+                image_names=[request.image_name for request in group],
+                annotate=annotate,
+                batch_size=len(group),
+            )
+        except Exception as e:
+            for request in group:
+                request.future.set_exception(e)
+            return
+
+        for request, output in zip(group, outputs):
+            request.future.set_result(output)
+
+    def pending(self):
+        """Number of images waiting to be batched."""
+        return self._queue.qsize()
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_service():
+    """
+    Return the process-wide inference service, running batches on the
+    replica pool when settings.INFERENCE_PROCESSES is set.
+    """
+    global _service
+    if _service is None:
+        with _service_lock:
+            if _service is None:
+                runner = classify_batch
+                if settings.INFERENCE_PROCESSES:
+                    from road_anomaly_detection_model.pool import classify_in_pool
+                    runner = classify_in_pool
+
+                _service = InferenceService(
+                    max_batch_size=settings.INFERENCE_MAX_BATCH_SIZE,
+                    max_wait=settings.INFERENCE_MAX_WAIT_MS / 1000,
+                    runner=runner,
+                    concurrency=settings.INFERENCE_PROCESSES or 1,
+                )
+    return _service
@@ -1,4 +1,188 @@
+"""
+Scratch space for files the pipeline has to put on a filesystem.
+
+Work happens in per-job directories under `scratch_root()`, created by
+`workspace()` and removed when it exits, whether the job succeeded or not:
+
+    with workspace('report-42') as ws:
+        path = ws.write('video.mp4', data)
+        ...
+
+The root is on /dev/shm (tmpfs) with settings.SCRATCH_ON_TMPFS, otherwise
+MODEL_MEDIA_ROOT. Writes fail with ScratchQuotaExceeded once the root
+holds SCRATCH_QUOTA_BYTES. `sweep()` (run periodically by the classifier
+workers and by `manage.py sweep_scratch`) removes what crashed processes
+left behind.
+"""
+import logging
 import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+from road_anomaly_detection import settings
+
+
+logger = logging.getLogger(__name__)
+
+TMPFS_ROOT = Path('/dev/shm/road_anomaly_detection')
+JOB_PREFIX = 'job-'
+# Loose files of the old temp-file pipeline, never the package's own files
+MEDIA_SUFFIXES = ('.mp4', '.avi', '.mov', '.jpg', '.jpeg', '.png', '.gif')
+
+
+class ScratchQuotaExceeded(OSError):
+    pass
+
+
+def scratch_root():
+    """The scratch directory, created if needed."""
+    if settings.SCRATCH_ON_TMPFS and TMPFS_ROOT.parent.is_dir():
+        root = TMPFS_ROOT
+    else:
+        root = Path(settings.MODEL_MEDIA_ROOT)
+    root.mkdir(parents=True, exist_ok=True)
+    return root
+
+
+def usage(root = None):
+    """Bytes of files under `root` (default: the scratch root)."""
+    total = 0
+    for directory, _, files in os.walk(root or scratch_root()):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(directory, name)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def _check_quota(root, size):
+    quota = settings.SCRATCH_QUOTA_BYTES
+    if quota and usage(root) + size > quota:
+        # Leftovers of crashed jobs may be what fills it
+        sweep(root=root)
+        if usage(root) + size > quota:
+            raise ScratchQuotaExceeded(f"Scratch space {root} is over its quota of {quota} bytes")
+
+
+class Workspace:
+    """A per-job scratch directory, see `workspace`."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def path_for(self, name):
+        """Path of `name` inside the workspace (the file is not created)."""
+        return self.path / Path(name).name
+
+    def write(self, name, data):
+        """
+        Write `data` to `name` inside the workspace.
+
+        Returns:
+            The file's path
+
+        Raises:
+            ScratchQuotaExceeded: If the scratch root would exceed its quota
+        """
+        _check_quota(self.path.parent, len(data))
+        path = self.path_for(name)
+        with open(path, 'wb') as file:
+            file.write(data)
+        return path
+
+
+@contextmanager
+def workspace(job = None):
+    """
+    Create a scratch directory for one job and remove it with everything
+    in it on exit, also when the job raises.
+
+    Args:
+        job: Label included in the directory name, for debugging
+
+    Yields:
+        The Workspace
+    """
+    root = scratch_root()
+    _check_quota(root, 0)
+
+    label = re.sub(r'[^A-Za-z0-9_.-]+', '_', str(job)) + '-' if job is not None else ''
+    path = tempfile.mkdtemp(prefix=f"{JOB_PREFIX}{label}", dir=root)
+    try:
+        yield Workspace(path)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def sweep(max_age = None, root = None):
+    """
+    Remove job directories and loose media files older than `max_age`
+    seconds (default settings.SCRATCH_MAX_AGE_SECONDS) from the scratch root.
+
+    Returns:
+        Tuple of (entries removed, bytes freed)
+    """
+    if max_age is None:
+        max_age = settings.SCRATCH_MAX_AGE_SECONDS
+    root = Path(root or scratch_root())
+    cutoff = time.time() - max_age
+    removed = freed = 0
+
+    for entry in os.scandir(root):
+        try:
+            if entry.is_dir(follow_symlinks=False) and entry.name.startswith(JOB_PREFIX):
+                if entry.stat(follow_symlinks=False).st_mtime <= cutoff:
+                    size = usage(entry.path)
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                    removed, freed = removed + 1, freed + size
+            elif entry.is_file(follow_symlinks=False) and entry.name.lower().endswith(MEDIA_SUFFIXES):
+                stat = entry.stat(follow_symlinks=False)
+                if stat.st_mtime <= cutoff:
+                    os.remove(entry.path)
+                    removed, freed = removed + 1, freed + stat.st_size
+        except FileNotFoundError:
+            # Removed by its job or another sweeper meanwhile
+            pass
+
+    if removed:
+        logger.info("Swept %d scratch entries (%d bytes) from %s", removed, freed, root)
+    return removed, freed
+
 
 def clear_temp_directory():
-    ...
+    """Remove every job directory and loose media file, regardless of age."""
+    return sweep(max_age=-1)
+
+
+_sweeper = None
+_sweeper_lock = threading.Lock()
+
+
+def start_sweeper(interval = None):
+    """
+    Sweep the scratch root every `interval` seconds (default
+    settings.SCRATCH_SWEEP_INTERVAL_SECONDS) on a daemon thread; once per process.
+    """
+    global _sweeper
+    if interval is None:
+        interval = settings.SCRATCH_SWEEP_INTERVAL_SECONDS
+
+    def run():
+        while True:
+            try:
+                sweep()
+            except OSError:
+                logger.exception("Scratch sweep failed")
+            time.sleep(interval)
+
+    with _sweeper_lock:
+        if _sweeper is None:
+            _sweeper = threading.Thread(target=run, name='scratch-sweeper', daemon=True)
+            _sweeper.start()
+    return _sweeper
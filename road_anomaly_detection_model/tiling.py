@@ -0,0 +1,134 @@
+"""
+Tiled inference for high-resolution images.
+
+The image is cut into overlapping tiles at native resolution, so hairline
+cracks are not lost to downsampling. Tiles go through the engine in batches
+of at most `max_tiles`, and boxes split across tile borders are merged back
+into one.
+"""
+import numpy as np
+
+from road_anomaly_detection_model.engines import batched_nms
+
+
+# Boxes of the same class overlapping by more than this share of the
+# smaller box are the same anomaly seen from two tiles
+MERGE_THRESHOLD = 0.5
+
+
+def tile_positions(length, tile_size, overlap):
+    """
+    Start offsets of overlapping tiles covering `length` pixels, the last
+    tile aligned with the image border.
+    """
+    if length <= tile_size:
+        return [0]
+
+    step = max(1, int(tile_size * (1 - overlap)))
+    positions = list(range(0, length - tile_size, step))
+    positions.append(length - tile_size)
+    return positions
+
+
+def tile_offsets(shape, tile_size, overlap):
+    """
+    (x, y) offsets of every tile of an image of `shape`.
+    """
+    height, width = shape[:2]
+    return [
+        (x, y)
+        for y in tile_positions(height, tile_size, overlap)
+        for x in tile_positions(width, tile_size, overlap)
+    ]
+
+
+def merge_detections(detections, threshold = MERGE_THRESHOLD):
+    """
+    Greedily merge same-class boxes whose intersection covers more than
+    `threshold` of the smaller box, keeping the union of the boxes and the
+    highest confidence.
+
+    Args:
+        detections: (N, 6) array of x1, y1, x2, y2, confidence, class_id
+
+    Returns:
+        Merged (M, 6) array, highest confidence first
+    """
+    if len(detections) == 0:
+        return detections
+
+    detections = detections[detections[:, 4].argsort()[::-1]]
+    x1, y1, x2, y2 = detections[:, 0], detections[:, 1], detections[:, 2], detections[:, 3]
+    areas = (x2 - x1) * (y2 - y1)
+    classes = detections[:, 5]
+
+    merged = []
+    remaining = np.arange(len(detections))
+    while remaining.size > 0:
+        best, rest = remaining[0], remaining[1:]
+
+        width = np.clip(np.minimum(x2[best], x2[rest]) - np.maximum(x1[best], x1[rest]), 0, None)
+        height = np.clip(np.minimum(y2[best], y2[rest]) - np.maximum(y1[best], y1[rest]), 0, None)
+        smaller = np.minimum(areas[best], areas[rest])
+        overlap = width * height / (smaller + 1e-9)
+
+        group = rest[(classes[rest] == classes[best]) & (overlap > threshold)]
+        members = np.concatenate(([best], group))
+
+        box = detections[best].copy()
+        box[:2] = detections[members, :2].min(axis=0)
+        box[2:4] = detections[members, 2:4].max(axis=0)
+        merged.append(box)
+
+        # setdiff1d returns sorted indices, which is confidence order here
+        remaining = np.setdiff1d(rest, group, assume_unique=True)
+
+    return np.stack(merged)
+
+
+def predict_tiled(model, image, conf, tile_size, overlap, max_tiles, full_image_size = None):
+    """
+    Run the engine on overlapping native-resolution tiles of `image`.
+
+    Args:
+        model: Inference engine
+        image: Decoded BGR ndarray
+        conf: Minimum confidence of a detection
+        tile_size: Tile side in pixels, also used as the network input size
+        overlap: Fraction of a tile shared with its neighbour
+        max_tiles: Most tiles held in memory / sent to the engine at once
+        full_image_size: Also run the downscaled full image at this size,
+                         so anomalies larger than a tile are still found
+
+    Returns:
+        (N, 6) detection array in image coordinates
+    """
+    found = []
+
+    if full_image_size:
+        found.append(model.predict([image], conf=conf, imgsz=full_image_size)[0])
+
+    max_tiles = max(1, max_tiles)
+    offsets = tile_offsets(image.shape, tile_size, overlap)
+    for start in range(0, len(offsets), max_tiles):
+        batch = offsets[start:start + max_tiles]
+
+        # Slices are views into `image`; the engine copies only this batch
+        tiles = [image[y:y + tile_size, x:x + tile_size] for x, y in batch]
+
+        for (x, y), detections in zip(batch, model.predict(tiles, conf=conf, imgsz=tile_size)):
+            if len(detections):
+                detections = detections.copy()
+                detections[:, [0, 2]] += x
+                detections[:, [1, 3]] += y
+                found.append(detections)
+
+    found = [detections for detections in found if len(detections)]
+    if not found:
+        return np.zeros((0, 6), dtype=np.float32)
+
+    detections = np.concatenate(found)
+
+    # Duplicates from overlapping tiles first, then boxes cut at tile borders
+    keep = batched_nms(detections[:, :4], detections[:, 4], detections[:, 5].astype(int))
+    return merge_detections(detections[keep])
@@ -0,0 +1,142 @@
+"""
+Per-stage timing of the classification pipeline.
+
+Stages are wrapped in `timed(...)`, used as a context manager or decorator:
+
+    with timed('decode'):
+        image = decode_image(data)
+
+    @timed('data_classifier')
+    def data_classifier(instance): ...
+
+Durations go to the configured sink (settings.PIPELINE_TIMING_SINK):
+
+    None      timing off; `timed` costs one attribute check
+    'log'     one structured log line per stage
+    'memory'  in-process histograms, see `get_sink().summary()`
+    'pkg.mod.Class'  any class with a `record(stage, seconds, **tags)` method,
+              e.g. an adapter for a metrics exporter
+"""
+import functools
+import importlib
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+
+import numpy as np
+
+from road_anomaly_detection import settings
+
+
+logger = logging.getLogger('road_anomaly_detection.timing')
+
+
+class LogSink:
+    """Logs `stage=<name> ms=<duration> <tags>` at INFO."""
+
+    def record(self, stage, seconds, **tags):
+        extra = ' '.join(f"{key}={value}" for key, value in tags.items())
+        logger.info("stage=%s ms=%.2f %s", stage, seconds * 1000, extra)
+
+
+class HistogramSink:
+    """Keeps the last `size` durations of every stage in memory."""
+
+    def __init__(self, size = 1000):
+        self._samples = defaultdict(lambda: deque(maxlen=size))
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds, **tags):
+        with self._lock:
+            self._samples[stage].append(seconds)
+
+    def summary(self):
+        """Count and p50/p95/p99/max in milliseconds per stage."""
+        with self._lock:
+            samples = {stage: np.asarray(values) * 1000 for stage, values in self._samples.items()}
+
+        return {
+            stage: {
+                "count": len(values),
+                "p50_ms": float(np.percentile(values, 50)),
+                "p95_ms": float(np.percentile(values, 95)),
+                "p99_ms": float(np.percentile(values, 99)),
+                "max_ms": float(values.max()),
+            }
+            for stage, values in samples.items() if len(values)
+        }
+
+    def reset(self):
+        with self._lock:
+            self._samples.clear()
+
+
+SINKS = {
+    'log': LogSink,
+    'memory': HistogramSink,
+}
+
+_sink = None
+
+
+def configure(sink = None):
+    """
+    Set the sink: None, a SINKS name, a dotted class path or a sink object.
+    """
+    global _sink
+    if isinstance(sink, str):
+        if sink in SINKS:
+            sink = SINKS[sink]()
+        else:
+            module, _, name = sink.rpartition('.')
+            sink = getattr(importlib.import_module(module), name)()
+    _sink = sink
+    return _sink
+
+
+def get_sink():
+    return _sink
+
+
+def record(stage, seconds, **tags):
+    """Report a duration measured elsewhere (e.g. by ultralytics)."""
+    if _sink is not None:
+        _sink.record(stage, seconds, **tags)
+
+
+class timed:
+    """
+    Time a block or function as pipeline stage `stage`.
+    """
+    __slots__ = ('stage', 'tags', '_start')
+
+    def __init__(self, stage, **tags):
+        self.stage = stage
+        self.tags = tags
+        self._start = None
+
+    def __enter__(self):
+        if _sink is not None:
+            self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if _sink is not None and self._start is not None:
+            _sink.record(self.stage, time.perf_counter() - self._start, **self.tags)
+        self._start = None
+        return False
+
+    def __call__(self, func):
+        stage, tags = self.stage, self.tags
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            # A fresh timer per call, so concurrent calls do not share state
+            with timed(stage, **tags):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+
+configure(settings.PIPELINE_TIMING_SINK)
@@ -0,0 +1,386 @@
+"""
+Video frame sampling.
+
+Only a handful of frames of a video are classified, so instead of decoding
+every frame we jump to the sampled ones: seek with CAP_PROP_POS_FRAMES when
+the container supports it, and `grab()` (demux/decode without the colour
+conversion and copy of `retrieve()`) over short gaps or when it does not.
+
+Uploaded videos are opened straight from memory (see `open_video_bytes`).
+
+`select_frames` then drops near-duplicate frames (e.g. while the vehicle is
+stopped) so the model only runs on frames that show something new;
+`iter_distinct_frames` does the same frame by frame for `prefetch_batches`,
+which decodes on a background thread while the caller runs inference.
+"""
+import logging
+import os
+import queue
+import threading
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+from road_anomaly_detection import settings
+from road_anomaly_detection_model.temp.temp import workspace
+
+
+logger = logging.getLogger(__name__)
+
+# Below this many frames, grabbing forward is cheaper than a seek
+# (a seek decodes from the previous keyframe anyway)
+SEEK_MIN_GAP = 30
+
+HASH_SIZE = 8
+HASH_BITS = HASH_SIZE * HASH_SIZE
+
+
+@contextmanager
+def open_video_bytes(data):
+    """
+    Open encoded video bytes with cv2.VideoCapture without writing them to disk.
+
+    On Linux the bytes go into an anonymous memfd that FFmpeg opens through
+    /proc/self/fd; it has no name on any filesystem and is freed when closed,
+    even if the job crashes. Elsewhere the video is written to a scratch
+    workspace, removed on exit.
+
+    Yields:
+        The opened capture
+    """
+    if hasattr(os, 'memfd_create') and os.path.isdir('/proc/self/fd'):
+        fd = os.memfd_create('video', os.MFD_CLOEXEC)
+        try:
+            _write_all(fd, data)
+            cap = cv2.VideoCapture(f"/proc/self/fd/{fd}")
+            try:
+                if not cap.isOpened():
+                    raise ValueError("Cannot open video")
+                yield cap
+            finally:
+                cap.release()
+        finally:
+            os.close(fd)
+        return
+
+    with workspace('video') as scratch:
+        cap = cv2.VideoCapture(str(scratch.write('video.mp4', data)))
+        try:
+            if not cap.isOpened():
+                raise ValueError("Cannot open video")
+            yield cap
+        finally:
+            cap.release()
+
+
+@contextmanager
+def open_video(source):
+    """
+    Open a video file path directly, or encoded bytes through `open_video_bytes`.
+
+    Yields:
+        The opened capture
+    """
+    if not isinstance(source, (str, os.PathLike)):
+        with open_video_bytes(source) as cap:
+            yield cap
+        return
+
+    cap = cv2.VideoCapture(str(source))
+    try:
+        if not cap.isOpened():
+            raise ValueError(f"Cannot open video: {source}")
+        yield cap
+    finally:
+        cap.release()
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+    os.lseek(fd, 0, os.SEEK_SET)
+
+
+def sample_indices(total_frames, max_frames):
+    """
+    Up to `max_frames` evenly spaced frame indices of a `total_frames` video.
+    """
+    if total_frames <= 0:
+        return []
+
+    step = max(1, total_frames // max_frames)
+    return list(range(0, total_frames, step))[:max_frames]
+
+
+def read_frames(cap, indices):
+    """
+    Yield (frame index, BGR frame) for each of the sorted `indices`.
+
+    Seeks to far-away targets when the backend supports it and falls back
+    to grabbing forward otherwise. If a seek lands on a later frame (nearest
+    keyframe), that frame is yielded with its actual index.
+    """
+    position = 0
+    seekable = True
+
+    for target in indices:
+        if target < position:
+            continue
+
+        if seekable and target - position > SEEK_MIN_GAP:
+            if cap.set(cv2.CAP_PROP_POS_FRAMES, target):
+                actual = int(cap.get(cv2.CAP_PROP_POS_FRAMES))
+                if actual >= 0:
+                    position = actual
+            else:
+                seekable = False
+                logger.debug("Video is not seekable, grabbing frames instead")
+
+        while position < target:
+            if not cap.grab():
+                return
+            position += 1
+
+        ok, frame = cap.read()
+        if not ok:
+            return
+
+        yield position, frame
+        position += 1
+
+
+def plan_segments(total_frames, fps, segment_seconds):
+    """
+    Split a video into consecutive segments of `segment_seconds`.
+
+    Returns:
+        List of (start frame, end frame) with `end` exclusive; a single
+        segment when the frame count is unknown or the video is short
+    """
+    segment_frames = int(round((fps if fps and fps > 0 else 30) * segment_seconds))
+    if total_frames <= 0 or segment_frames <= 0 or total_frames <= segment_frames:
+        return [(0, total_frames if total_frames > 0 else None)]
+
+    return [(start, min(start + segment_frames, total_frames)) for start in range(0, total_frames, segment_frames)]
+
+
+def _range_indices(cap, count, start, end):
+    """`count` evenly spaced frame indices of [start, end), or None if the length is unknown."""
+    if end is None:
+        end = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if end <= 0:
+            return None
+    return [start + index for index in sample_indices(end - start, count)]
+
+
+def sample_frames(cap, max_frames, start = 0, end = None):
+    """
+    Read up to `max_frames` evenly spaced frames of an opened capture,
+    optionally only of the frames [start, end).
+
+    Returns:
+        List of (frame index, BGR frame)
+    """
+    indices = _range_indices(cap, max_frames, start, end)
+
+    if indices is None:
+        # Frame count unknown (e.g. streamed containers): one frame per second
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        step = int(fps) if fps and fps > 0 else 30
+        return list(read_frames(cap, range(start, start + step * max_frames, step)))
+
+    return list(read_frames(cap, indices))
+
+
+def frame_hash(frame):
+    """
+    64-bit difference hash of a BGR frame: the sign of the horizontal
+    gradient of a 9x8 grayscale thumbnail. Robust to compression noise and
+    small exposure changes, cheap enough to compute for every candidate.
+    """
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+    small = cv2.resize(gray, (HASH_SIZE + 1, HASH_SIZE), interpolation=cv2.INTER_AREA)
+    return (small[:, 1:] > small[:, :-1]).ravel()
+
+
+def hash_distance(a, b):
+    """Number of differing bits between two frame hashes."""
+    return int(np.count_nonzero(a != b))
+
+
+def select_frames(candidates, max_frames, threshold = None):
+    """
+    Pick up to `max_frames` distinct, high-change frames out of `candidates`.
+
+    Each candidate is scored by how much it differs from the previous one
+    (the first frame always qualifies). Frames are taken by decreasing score
+    and skipped when within `threshold` bits of a frame already taken, so a
+    stretch of near-identical frames contributes one frame at most.
+
+    Args:
+        candidates: List of (frame index, BGR frame) in video order
+        max_frames: Most frames to return
+        threshold: Hash distance at or below which frames are duplicates
+                   (default settings.VIDEO_DUPLICATE_THRESHOLD)
+
+    Returns:
+        The selected (frame index, BGR frame) in video order
+    """
+    if threshold is None:
+        threshold = settings.VIDEO_DUPLICATE_THRESHOLD
+
+    hashes = [frame_hash(frame) for _, frame in candidates]
+    change = [HASH_BITS] + [hash_distance(hashes[i], hashes[i - 1]) for i in range(1, len(hashes))]
+
+    selected = []
+    # sorted() is stable, so among equal scores the earlier frame wins
+    for i in sorted(range(len(candidates)), key=lambda i: -change[i]):
+        if len(selected) == max_frames:
+            break
+        if all(hash_distance(hashes[i], hashes[j]) > threshold for j in selected):
+            selected.append(i)
+
+    return [candidates[i] for i in sorted(selected)]
+
+
+def sample_distinct_frames(cap, max_frames, candidate_factor = None, threshold = None, start = 0, end = None):
+    """
+    Read `candidate_factor` x `max_frames` evenly spaced candidates of an
+    opened capture and keep at most `max_frames` distinct ones.
+
+    Decoding and hashing a few extra frames is far cheaper than running the
+    model on duplicates.
+
+    Returns:
+        List of (frame index, BGR frame)
+    """
+    if candidate_factor is None:
+        candidate_factor = settings.VIDEO_CANDIDATE_FACTOR
+
+    candidates = sample_frames(cap, max_frames * max(1, candidate_factor), start, end)
+    selected = select_frames(candidates, max_frames, threshold)
+    logger.debug("Selected %d of %d candidate frames", len(selected), len(candidates))
+    return selected
+
+
+def iter_distinct_frames(cap, max_frames, candidate_factor = None, threshold = None, start = 0, end = None):
+    """
+    Streaming counterpart of `sample_distinct_frames`.
+
+    The `candidate_factor` x `max_frames` candidates are split into
+    `max_frames` consecutive windows; each window yields its frame that
+    differs most from the previous yielded one, unless it is within
+    `threshold` bits of a frame already yielded. Only one window of frames
+    is held at a time and the whole video stays covered.
+
+    Yields:
+        (frame index, BGR frame) in video order
+    """
+    if candidate_factor is None:
+        candidate_factor = settings.VIDEO_CANDIDATE_FACTOR
+    if threshold is None:
+        threshold = settings.VIDEO_DUPLICATE_THRESHOLD
+    candidate_factor = max(1, candidate_factor)
+
+    indices = _range_indices(cap, max_frames * candidate_factor, start, end)
+    if indices is None:
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        step = max(1, (int(fps) if fps and fps > 0 else 30) // candidate_factor)
+        indices = range(start, start + step * max_frames * candidate_factor, step)
+
+    kept = []
+    window = []
+
+    def best_of(window):
+        previous = kept[-1] if kept else None
+        change, hashed, candidate = max(
+            ((HASH_BITS if previous is None else hash_distance(h, previous), h, candidate) for h, candidate in window),
+            key=lambda item: item[0],
+        )
+        if all(hash_distance(hashed, h) > threshold for h in kept):
+            kept.append(hashed)
+            return candidate
+        return None
+
+    for index, frame in read_frames(cap, indices):
+        window.append((frame_hash(frame), (index, frame)))
+        if len(window) == candidate_factor:
+            candidate = best_of(window)
+            window = []
+            if candidate is not None:
+                yield candidate
+
+    if window:
+        candidate = best_of(window)
+        if candidate is not None:
+            yield candidate
+
+
+_DONE = object()
+
+
+def prefetch_batches(frames, batch_size, queue_size = None):
+    """
+    Run the `frames` iterator on a decoder thread and yield its items in
+    batches of up to `batch_size`.
+
+    The thread stays at most `queue_size` items ahead, which bounds memory.
+    A batch is handed out as soon as at least one item is ready, so the
+    caller's inference on one batch overlaps decoding of the next. Errors
+    of the decoder are raised in the caller. Close the generator (or use
+    contextlib.closing) before releasing the capture the iterator reads.
+    """
+    if queue_size is None:
+        queue_size = settings.VIDEO_QUEUE_SIZE
+
+    buffer = queue.Queue(maxsize=max(1, queue_size))
+    stop = threading.Event()
+    error = []
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in frames:
+                if not put(item):
+                    return
+        except Exception as e:
+            error.append(e)
+        put(_DONE)
+
+    thread = threading.Thread(target=produce, name='video-decoder', daemon=True)
+    thread.start()
+
+    try:
+        done = False
+        while not done:
+            batch = []
+            item = buffer.get()
+            while item is not _DONE:
+                batch.append(item)
+                if len(batch) >= batch_size:
+                    break
+                try:
+                    item = buffer.get_nowait()
+                except queue.Empty:
+                    break
+            done = item is _DONE
+
+            if batch:
+                yield batch
+
+        if error:
+            raise error[0]
+    finally:
+        stop.set()
+        thread.join()